@@ -0,0 +1,717 @@
+# Bits shared between BackupPC_archiveHost_s3 and backup-manager.py: how
+# archived keys are named, and how their chunks are compressed.
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import calendar
+import glob
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import string
+import threading
+import time
+
+from distutils.spawn import find_executable
+
+# Where local state (the catalog, and so on) lives, unless secrets.py says
+# otherwise with statedir.
+DEFAULT_STATEDIR = os.path.expanduser('~/.backuppc-archive-s3')
+
+# Deduplicated chunks live under this prefix in the host's bucket, named
+# for the HMAC of their contents, and are shared between backups.  Each
+# such backup gets a host.123.tar.MANIFEST key listing its chunks in order.
+CHUNK_PREFIX = 'chunks/'
+
+# Staged deduplicated chunks are named host.123.tar.dedup-<hash> on disk.
+DEDUP_MARK = 'dedup-'
+
+# A backup's host.123.tar.INDEX key is gzipped JSON, gpg-encrypted if the
+# chunks are; the gzip magic number tells the two apart.
+GZIP_MAGIC = '\x1f\x8b'
+
+# Codecs for the archiver's compression stage.  A compressed chunk gets the
+# codec's extension ahead of .gpg (host.123.tar.aa.zst.gpg), which is all a
+# restore needs to know to undo it.
+CODECS = {
+    'zstd': {
+        'ext': 'zst',
+        'level': 3,
+        'compress': ['zstd', '-q', '-c', '-%(level)i'],
+        'decompress': ['zstd', '-q', '-d', '-c'],
+    },
+    'lz4': {
+        'ext': 'lz4',
+        'level': 1,
+        'compress': ['lz4', '-q', '-c', '-%(level)i'],
+        'decompress': ['lz4', '-q', '-d', '-c'],
+    },
+    'bzip2': {
+        'ext': 'bz2',
+        'level': 9,
+        'compress': ['bzip2', '-c', '-%(level)i'],
+        'decompress': ['bzip2', '-d', '-c'],
+    },
+}
+
+CODEC_EXTENSIONS = dict((spec['ext'], codec) for codec, spec in CODECS.items())
+
+
+def compress_command(codec, level=None):
+    "Returns the command line that compresses stdin to stdout with codec"
+    spec = CODECS[codec]
+    if level is None:
+        level = spec['level']
+    cmd = [arg % {'level': level} for arg in spec['compress']]
+    cmd[0] = find_executable(cmd[0]) or cmd[0]
+    return cmd
+
+
+def decompress_command(codec):
+    "Returns the command line that decompresses stdin to stdout for codec"
+    cmd = list(CODECS[codec]['decompress'])
+    cmd[0] = find_executable(cmd[0]) or cmd[0]
+    return cmd
+
+
+def parse_key(name):
+    """Splits a key (or staged file) name like host.123.tar.aa.zst.gpg into a
+       dict of:
+        {'hostname': Hostname (str), or None for a shared chunk,
+         'backupnum': Backup number (int), or None for a shared chunk,
+         'chunk': split suffix (str), or None if unsplit,
+         'dedup': hash of a deduplicated chunk (str), or None,
+         'codec': compression codec name, or None,
+         'encrypted': True if the key is gpg-encrypted,
+         'final': True for the COMPLETE marker,
+         'manifest': True for the MANIFEST key,
+         'index': True for the INDEX key
+        }
+       Returns None if the name isn't one of ours."""
+
+    info = {'chunk': None, 'dedup': None, 'codec': None, 'encrypted': False,
+            'final': False, 'manifest': False, 'index': False}
+
+    if name.startswith(CHUNK_PREFIX):
+        keyparts = name[len(CHUNK_PREFIX):].split('.')
+        info['hostname'] = info['backupnum'] = None
+    else:
+        keyparts = name.split('.')
+
+    if keyparts[-1] == 'COMPLETE':
+        info['final'] = True
+        keyparts.pop() # back to tar
+        keyparts.pop() # back to backup number
+    elif keyparts[-1] == 'MANIFEST':
+        info['manifest'] = True
+        keyparts.pop() # back to tar
+        keyparts.pop() # back to backup number
+    elif keyparts[-1] == 'INDEX':
+        info['index'] = True
+        keyparts.pop() # back to tar
+        keyparts.pop() # back to backup number
+    else:
+        if keyparts[-1] == 'gpg':
+            info['encrypted'] = True
+            keyparts.pop()
+
+        if keyparts[-1] in CODEC_EXTENSIONS:
+            info['codec'] = CODEC_EXTENSIONS[keyparts.pop()]
+
+        if name.startswith(CHUNK_PREFIX):
+            info['dedup'] = keyparts.pop()
+            return info
+
+        if keyparts[-1].startswith(DEDUP_MARK):
+            info['dedup'] = keyparts.pop()[len(DEDUP_MARK):]
+        elif is_split_suffix(keyparts[-1]):
+            info['chunk'] = keyparts.pop()
+
+        if keyparts[-1] == 'tar':
+            keyparts.pop()
+
+    if len(keyparts) < 2:
+        return None
+
+    try:
+        info['backupnum'] = int(keyparts.pop())
+    except ValueError:
+        return None
+
+    info['hostname'] = '.'.join(keyparts)
+    return info
+
+
+def is_split_suffix(suffix):
+    """Returns True if suffix is one split_suffixes would give: two letters,
+       or, past yz, a run of z's and two more letters than there are z's"""
+    width = len(suffix) - len(suffix.lstrip('z'))
+    rest = suffix[width:]
+    return (len(rest) == width + 2 and rest[0] in string.ascii_lowercase[:25]
+            and all([c in string.ascii_lowercase for c in rest]))
+
+
+def split_suffixes():
+    "Yields the same output suffixes as GNU split: aa..yz, zaaa..zyzz, etc."
+    prefix = ''
+    width = 2
+    while True:
+        for letters in itertools.product(string.ascii_lowercase, repeat=width):
+            if letters[0] != 'z':
+                yield prefix + ''.join(letters)
+        prefix += 'z'
+        width += 1
+
+
+def key_name(filename):
+    "Returns the S3 key name a staged file is uploaded as"
+    basename = os.path.basename(filename)
+    info = parse_key(basename)
+    if info and info['dedup']:
+        return CHUNK_PREFIX + basename[basename.index(DEDUP_MARK) + len(DEDUP_MARK):]
+    return basename
+
+
+def s3_connection_args(config):
+    """Returns the keyword arguments for S3Connection that point it at the
+       endpoint named by config (the secrets module): s3_host, s3_port and
+       s3_secure, for an S3-compatible service such as benchmarks/fakes3.py.
+       By default, that's AWS over HTTPS."""
+    args = {'is_secure': getattr(config, 's3_secure', True)}
+    if getattr(config, 's3_host', None):
+        from boto.s3.connection import OrdinaryCallingFormat
+        args['host'] = config.s3_host
+        args['calling_format'] = OrdinaryCallingFormat()
+    if getattr(config, 's3_port', None):
+        args['port'] = config.s3_port
+    return args
+
+
+def state_dir(statedir=None):
+    "Returns the (expanded) state directory, creating it if need be"
+    if statedir is None:
+        statedir = DEFAULT_STATEDIR
+    statedir = os.path.expanduser(statedir)
+    if not os.path.isdir(statedir):
+        os.makedirs(statedir, 0700)
+    return statedir
+
+
+def job_file(statedir, hostname, kind):
+    """Returns the path of a file describing hostname's archive job: its
+       'status', written by the archiver, or its 'budget', written by the
+       scheduler in backup-manager.py."""
+    jobdir = os.path.join(state_dir(statedir), 'jobs')
+    if not os.path.isdir(jobdir):
+        os.makedirs(jobdir, 0700)
+    return os.path.join(jobdir, '%s.%s' % (hostname, kind))
+
+
+def read_job(statedir, hostname, kind):
+    "Returns the contents of a job file as a dict, or None"
+    try:
+        fd = open(job_file(statedir, hostname, kind))
+    except IOError:
+        return None
+    try:
+        return json.load(fd)
+    except ValueError:
+        return None
+    finally:
+        fd.close()
+
+
+def write_job(statedir, hostname, kind, info):
+    "Replaces a job file with the dict info"
+    _replace_file(job_file(statedir, hostname, kind), json.dumps(info))
+
+
+class Throttle:
+    """Holds a process's uploads to an average of rate bytes per second.
+       Shared by threads; each calls consume() after sending some bytes, and
+       sleeps for as long as it takes the average to come back down."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RunMetrics:
+    """Counters for one archiver run: bytes, files, seconds and retries for
+       each stage of the pipeline, plus the depth of each queue and the
+       bytes of scratch space staged over time.
+       Written out as JSON, and optionally as a Prometheus textfile for
+       node_exporter's textfile collector."""
+
+    def __init__(self, hostname, backupnum):
+        self.hostname = hostname
+        self.backupnum = backupnum
+        self.started = time.time()
+        self.finished = None
+        self.success = False
+        self.stages = {}
+        self.queues = {}
+        self.scratch = []
+        self.settings = {}
+
+    def add(self, stage, **counters):
+        "Adds counters (bytes_in=..., seconds=..., etc) to a stage's totals"
+        totals = self.stages.setdefault(stage, {})
+        for name, value in counters.items():
+            totals[name] = totals.get(name, 0) + value
+
+    def sample(self, qname, depth):
+        "Records a queue's depth at this moment"
+        self.queues.setdefault(qname, []).append(
+            (round(time.time() - self.started, 1), depth))
+
+    def sample_scratch(self, used):
+        "Records the bytes staged in scratch space at this moment"
+        self.scratch.append((round(time.time() - self.started, 1), used))
+
+    def summary(self):
+        "Returns the whole run as a dict"
+        finished = self.finished or time.time()
+        read = self.stages.get('tar', {}).get('bytes_out', 0)
+        uploaded = self.stages.get('upload', {}).get('bytes', 0)
+        ratio = None
+        if read and uploaded:
+            ratio = round(float(read) / uploaded, 3)
+        return {
+            'hostname': self.hostname,
+            'backupnum': self.backupnum,
+            'started': self.started,
+            'finished': finished,
+            'seconds': round(finished - self.started, 1),
+            'success': self.success,
+            'bytes_read': read,
+            'bytes_uploaded': uploaded,
+            'compression_ratio': ratio,
+            'stages': self.stages,
+            'throughput': stage_throughput(self.stages),
+            'queues': self.queues,
+            'scratch': self.scratch,
+            'settings': self.settings,
+        }
+
+    def write_json(self, filename):
+        _replace_file(filename, json.dumps(self.summary(), indent=1,
+                                           sort_keys=True))
+
+    def write_prometheus(self, filename):
+        summary = self.summary()
+        host = 'host="%s"' % self.hostname.replace('\\', '\\\\').replace('"', '\\"')
+        families = []
+        samples = {}
+
+        def metric(name, value, help, labels=''):
+            # a family's samples have to be listed together
+            name = 'backuppc_archive_' + name
+            if name not in samples:
+                families.append(name)
+                samples[name] = ['# HELP %s %s' % (name, help),
+                                 '# TYPE %s gauge' % name]
+            samples[name].append('%s{%s%s} %s' % (name, host, labels, value))
+
+        metric('last_run_timestamp_seconds', int(summary['finished']),
+               'When the last archive run finished.')
+        metric('last_run_duration_seconds', summary['seconds'],
+               'How long the last archive run took.')
+        metric('last_run_success', int(summary['success']),
+               'Whether the last archive run finalized its backup.')
+        metric('last_run_backupnum', self.backupnum,
+               'The backup number the last archive run wrote.')
+        metric('last_run_bytes_read', summary['bytes_read'],
+               'Bytes of tar stream the last archive run read.')
+        metric('last_run_bytes_uploaded', summary['bytes_uploaded'],
+               'Bytes the last archive run uploaded.')
+        if summary['compression_ratio'] is not None:
+            metric('last_run_compression_ratio', summary['compression_ratio'],
+                   'Bytes read per byte uploaded in the last archive run.')
+        for stage, totals in sorted(self.stages.items()):
+            for name, value in sorted(totals.items()):
+                metric('stage_%s' % name, value,
+                       'Per-stage %s in the last archive run.' % name,
+                       ',stage="%s"' % stage)
+        for qname, samples in sorted(self.queues.items()):
+            metric('queue_depth_max', max([d for t, d in samples] or [0]),
+                   'Deepest each queue got in the last archive run.',
+                   ',queue="%s"' % qname)
+        if self.scratch:
+            metric('scratch_bytes_max', max([u for t, u in self.scratch]),
+                   'Most scratch space the last archive run had staged.')
+
+        lines = []
+        for name in families:
+            lines.extend(samples[name])
+        _replace_file(filename, '\n'.join(lines) + '\n')
+
+
+# The counter that measures the work each stage did, for stage_throughput
+STAGE_BYTES = {
+    'tar': 'bytes_out',
+    'split': 'bytes_in',
+    'compress': 'bytes_in',
+    'encrypt': 'bytes_in',
+    'upload': 'bytes',
+}
+
+# Bounds on the chunk size autotune picks; below 16MB, the per-chunk
+# overheads start to tell, and S3 takes no more than 5GB in one PUT.
+MIN_SPLIT = 16 * 1024 * 1024
+MAX_SPLIT = 5 * 1024 * 1024 * 1024
+
+
+def stage_throughput(stages):
+    """Returns {stage: bytes per second} from RunMetrics stage totals.  A
+       stage's seconds are added up across its workers, so this is what one
+       worker of the stage manages."""
+    rates = {}
+    for stage, counter in STAGE_BYTES.items():
+        totals = stages.get(stage, {})
+        if totals.get(counter) and totals.get('seconds'):
+            rates[stage] = totals[counter] / float(totals['seconds'])
+    return rates
+
+
+def load_history(metricsdir, hostname, limit=10):
+    """Returns the summaries of up to limit recent successful runs from the
+       metrics JSON files in metricsdir, newest first: this host's, if it
+       has any, or else any host's."""
+    runs = []
+    for filename in glob.glob(os.path.join(metricsdir, '*.json')):
+        try:
+            summary = json.load(open(filename))
+        except (IOError, ValueError):
+            continue
+        if summary.get('success'):
+            runs.append(summary)
+    runs.sort(key=lambda run: run['started'], reverse=True)
+    mine = [run for run in runs if run['hostname'] == hostname]
+    return (mine or runs)[:limit]
+
+
+def _rate(rate):
+    return '%.1f MB/s' % (rate / 1048576.0)
+
+
+def autotune(history, cpus, scratch=None, splitsize=0, codec=None,
+             max_senders=8, chunk_seconds=60):
+    """Picks the worker counts for a run, and its chunk size if splitsize
+       isn't 0, from the stages' throughput in past runs (see load_history),
+       the cpus to hand and the bytes of scratch space free, if known.
+       Each stage gets enough workers to keep up with tarCreate, and chunks
+       take about chunk_seconds to upload.  Returns a dict of whichever of
+       compression_workers, encryption_workers, sending_workers and
+       splitsize it could decide on, and a list of its reasons, for the log."""
+    choices = {}
+    reasons = []
+
+    totals = {}
+    for run in history:
+        for stage, counters in run['stages'].items():
+            stagetotals = totals.setdefault(stage, {})
+            for name, value in counters.items():
+                stagetotals[name] = stagetotals.get(name, 0) + value
+    rates = stage_throughput(totals)
+
+    if 'tar' not in rates:
+        reasons.append('no past runs to go on, keeping the defaults')
+        return choices, reasons
+
+    def workers(stage, flow, most):
+        wanted = max(1, int(math.ceil(flow / rates[stage])))
+        count = min(most, wanted)
+        reason = '%i %s workers at %s each for %s' % (
+                 count, stage, _rate(rates[stage]), _rate(flow))
+        if count < wanted:
+            reason += ' (%i wanted, %i at most)' % (wanted, most)
+        reasons.append(reason)
+        return count
+
+    flow = rates['tar']
+    reasons.append('tarCreate ran at %s over the last %i runs' % (
+                   _rate(flow), len(history)))
+    if codec and 'compress' in rates:
+        choices['compression_workers'] = workers('compress', flow, cpus)
+        flow *= totals['compress'].get('bytes_out', 0) / float(totals['compress']['bytes_in'])
+    if 'encrypt' in rates:
+        choices['encryption_workers'] = workers('encrypt', flow, cpus)
+        flow *= totals['encrypt'].get('bytes_out', 0) / float(totals['encrypt']['bytes_in'])
+    if 'upload' in rates:
+        choices['sending_workers'] = workers('upload', flow, max_senders)
+
+    if splitsize > 0 and 'upload' in rates:
+        size = rates['upload'] * chunk_seconds
+        why = 'to upload in about %i seconds' % chunk_seconds
+        least = MIN_SPLIT
+        if scratch:
+            # a chunk in each worker, and as many again in its output,
+            # plus one being cut and one waiting
+            inflight = sum([choices.get(name, 1) for name in
+                            ['compression_workers', 'encryption_workers',
+                             'sending_workers']]) + 2
+            if scratch // (2 * inflight) < size:
+                size = scratch // (2 * inflight)
+                why = 'to fit %i in flight in %.1fMB of scratch space' % (
+                      inflight, scratch / 1048576.0)
+                if size < MIN_SPLIT:
+                    # the scratch space wins over the usual least size
+                    least = 1048576
+                    why += ', below the usual %iMB' % (MIN_SPLIT // 1048576)
+                    if size < least:
+                        why = ('as the least; %i in flight won\'t fit in '
+                               '%.1fMB of scratch space' % (
+                               inflight, scratch / 1048576.0))
+        size = max(least, min(MAX_SPLIT, int(size))) // 1048576 * 1048576
+        choices['splitsize'] = size
+        reasons.append('%iMB chunks %s' % (size // 1048576, why))
+
+    return choices, reasons
+
+
+class Tracer:
+    """Records spans of a run's work as Chrome trace events, the JSON that
+       chrome://tracing and Perfetto load.  Made in main before the workers
+       are started, so each process carries on with its own copy, which
+       appends its events to prefix.<pid>.part, a line at a time.  Spans in
+       the 'idle' category are time spent waiting; merge_traces collects
+       everything into one timeline at the end of the run."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.started = time.time()
+        self._named = set()
+
+    def _write(self, events):
+        fd = os.open('%s.%i.part' % (self.prefix, os.getpid()),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, ''.join([json.dumps(e) + '\n' for e in events]))
+        finally:
+            os.close(fd)
+
+    def span(self, name, cat, start, end=None, **args):
+        """Records a span from start to end (or now), in seconds since the
+           epoch, on the calling process and thread's track"""
+        if end is None:
+            end = time.time()
+        pid = os.getpid()
+        tid = threading.current_thread().ident
+        events = []
+        if (pid, tid) not in self._named:
+            # Chrome trace metadata events name the tracks
+            self._named.add((pid, tid))
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name':
+                           multiprocessing.current_process().name}})
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name':
+                           threading.current_thread().name}})
+        events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': pid,
+                       'tid': tid, 'ts': int((start - self.started) * 1e6),
+                       'dur': int(max(0, end - start) * 1e6), 'args': args})
+        self._write(events)
+
+
+def merge_traces(prefix, filename):
+    """Gathers the events each process wrote for a Tracer with this prefix
+       into one trace file, and removes the parts.  Returns the events."""
+    events = []
+    for part in glob.glob(prefix + '.*.part'):
+        for line in open(part):
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue    # cut short by a crash
+        os.unlink(part)
+    _replace_file(filename, json.dumps({'traceEvents': events,
+                                        'displayTimeUnit': 'ms'}))
+    return events
+
+
+def trace_summary(events):
+    """Returns {process name: (seconds from its first span to its last,
+       seconds of it spent in 'idle' spans)} from merged trace events"""
+    names = {}
+    bounds = {}
+    idle = {}
+    for event in events:
+        pid = event['pid']
+        if event['ph'] == 'M':
+            if event['name'] == 'process_name':
+                names[pid] = event['args']['name']
+            continue
+        first, last = bounds.get(pid, (event['ts'], event['ts']))
+        bounds[pid] = (min(first, event['ts']),
+                       max(last, event['ts'] + event['dur']))
+        if event.get('cat') == 'idle':
+            idle[pid] = idle.get(pid, 0) + event['dur']
+    summary = {}
+    for pid, (first, last) in bounds.items():
+        summary[names.get(pid, str(pid))] = ((last - first) / 1e6,
+                                             idle.get(pid, 0) / 1e6)
+    return summary
+
+
+def _replace_file(filename, contents):
+    "Writes contents to filename, so that readers never see half of it"
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    fd = open(tmpname, 'w')
+    fd.write(contents)
+    fd.close()
+    os.rename(tmpname, filename)
+
+
+def parse_timestamp(last_modified):
+    "Turns an S3 listing timestamp (2011-09-10T12:34:56.000Z) into epoch seconds"
+    return calendar.timegm((int(last_modified[0:4]), int(last_modified[5:7]),
+                            int(last_modified[8:10]), int(last_modified[11:13]),
+                            int(last_modified[14:16]), int(last_modified[17:19]),
+                            0, 0, 0))
+
+
+class Catalog:
+    """A local SQLite record of the keys in each backup bucket, so that
+       listing backups doesn't mean walking every key of every bucket.
+
+       A bucket is only listed again once its entry is older than max_age,
+       or on request; in between, the archiver and backup-manager.py record
+       the keys they add and delete here as they go."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            refreshed INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS keys (
+            bucket TEXT,
+            name TEXT,
+            hostname TEXT,
+            backupnum INTEGER,
+            size INTEGER,
+            etag TEXT,
+            last_modified INTEGER,
+            PRIMARY KEY (bucket, name)
+        );
+        CREATE TABLE IF NOT EXISTS manifests (
+            bucket TEXT,
+            name TEXT,
+            etag TEXT,
+            body TEXT,
+            PRIMARY KEY (bucket, name)
+        );
+    """
+
+    def __init__(self, statedir=None, max_age=86400):
+        self.max_age = max_age
+        self._db = sqlite3.connect(os.path.join(state_dir(statedir),
+                                                'catalog.sqlite'),
+                                   timeout=60)
+        self._db.text_factory = str
+        for attempt in range(5):
+            try:
+                self._db.executescript(self.SCHEMA)
+                break
+            except sqlite3.OperationalError, e:
+                # the sending workers all open the catalog at once, and one
+                # creating the tables trips up the others on a new statedir
+                if 'schema has changed' not in str(e) or attempt == 4:
+                    raise
+
+    def is_fresh(self, bucketname):
+        "Returns True if the bucket was listed within max_age"
+        row = self._db.execute('SELECT refreshed FROM buckets WHERE name = ?',
+                               (bucketname,)).fetchone()
+        return (row is not None and row[0] is not None
+                and time.time() - row[0] < self.max_age)
+
+    def keys(self, bucketname):
+        "Returns (name, size, etag, last_modified) for each key in the bucket"
+        return self._db.execute('SELECT name, size, etag, last_modified '
+                                'FROM keys WHERE bucket = ? ORDER BY name',
+                                (bucketname,)).fetchall()
+
+    def refresh_bucket(self, bucketname, keys):
+        "Replaces a bucket's keys with a fresh listing of (name, size, etag, last_modified)"
+        db = self._db
+        db.execute('DELETE FROM keys WHERE bucket = ?', (bucketname,))
+        db.executemany('INSERT INTO keys VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       [self._row(bucketname, *key) for key in keys])
+        db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?)',
+                   (bucketname, int(time.time())))
+        db.commit()
+
+    def add_key(self, bucketname, name, size, etag, last_modified=None):
+        "Records a key that was just uploaded"
+        if last_modified is None:
+            last_modified = int(time.time())
+        self._db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         self._row(bucketname, name, size, etag, last_modified))
+        self._db.commit()
+
+    def delete_keys(self, bucketname, names):
+        "Forgets keys that were just deleted, in one transaction"
+        rows = [(bucketname, name) for name in names]
+        self._db.executemany('DELETE FROM keys WHERE bucket = ? AND name = ?',
+                             rows)
+        self._db.executemany('DELETE FROM manifests '
+                             'WHERE bucket = ? AND name = ?', rows)
+        self._db.commit()
+
+    def forget_buckets(self, keep):
+        "Drops every bucket not named in keep"
+        for (name,) in self._db.execute('SELECT name FROM buckets').fetchall():
+            if name not in keep:
+                self._db.execute('DELETE FROM buckets WHERE name = ?', (name,))
+                self._db.execute('DELETE FROM keys WHERE bucket = ?', (name,))
+                self._db.execute('DELETE FROM manifests WHERE bucket = ?', (name,))
+        self._db.commit()
+
+    def get_manifest(self, bucketname, name, etag):
+        "Returns a cached manifest body, or None"
+        row = self._db.execute('SELECT body FROM manifests WHERE bucket = ? '
+                               'AND name = ? AND etag = ?',
+                               (bucketname, name, etag)).fetchone()
+        return row and row[0]
+
+    def put_manifest(self, bucketname, name, etag, body):
+        "Caches a manifest body"
+        self._db.execute('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?)',
+                         (bucketname, name, etag, body))
+        self._db.commit()
+
+    def _row(self, bucketname, name, size, etag, last_modified):
+        info = parse_key(name) or {'hostname': None, 'backupnum': None}
+        return (bucketname, name, info['hostname'], info['backupnum'],
+                size, etag, last_modified)
@@ -22,29 +22,57 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import archivelib
+import bisect
+import boto.exception
+import errno
+import fnmatch
+import gzip
+import json
 import optparse
 import os
 import pwd
+import random
 import secrets
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import time
 
 from boto.s3.connection import S3Connection
 
 from collections import defaultdict
-from math import log10
-from subprocess import Popen
+from cStringIO import StringIO
+from math import ceil, log10
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
+
+# S3's limit on keys per multi-object delete request
+DELETE_BATCH = 1000
 
 
 class BackupManager:
 
-    def __init__(self, accesskey, sharedkey):
+    def __init__(self, accesskey, sharedkey, catalog=None, refresh=False,
+                 threads=16):
         self._accesskey = accesskey
-        self._connection = S3Connection(accesskey, sharedkey)
+        self._sharedkey = sharedkey
+        self._connection = S3Connection(accesskey, sharedkey,
+                                        **archivelib.s3_connection_args(secrets))
+        self._catalog = catalog
+        self._refresh = refresh
+        self._threads = threads
+        self._local = threading.local()
 
         self._buckets = None
         self._bucketbackups = {}
         self._backups = None
+        self._manifests = {}
+        self._listed = set()
+        self._listings = {}
 
     def _generate_backup_buckets(self):
         bucket_prefix = self._accesskey.lower() + '-bkup-'
@@ -55,12 +83,60 @@ class BackupManager:
             if bucket.name.startswith(bucket_prefix):
                 self._buckets.append(bucket)
 
+        if self._catalog is not None:
+            self._catalog.forget_buckets([b.name for b in self._buckets])
+
     @property
     def backup_buckets(self):   # property
         if self._buckets is None:
             self._generate_backup_buckets()
         return self._buckets
 
+    def _needs_listing(self, bucket):
+        "Returns True if the catalog can't stand in for listing the bucket"
+        if self._catalog is None:
+            return bucket.name not in self._listed
+        if bucket.name in self._listed:
+            return False
+        if self._refresh is True or bucket.name in (self._refresh or ()):
+            return True
+        return not self._catalog.is_fresh(bucket.name)
+
+    def _thread_bucket(self, bucketname):
+        "Returns a bucket on this thread's own S3 connection"
+        # boto connections aren't thread-safe, so each thread gets its own
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = S3Connection(self._accesskey,
+                                    self._sharedkey,
+                                    **archivelib.s3_connection_args(secrets))
+        return self._local.connection.get_bucket(bucketname, validate=False)
+
+    def _fetch_listing(self, bucketname):
+        """Lists a bucket from S3, returning (name, size, etag, last_modified)
+           for each key.  Safe to call from several threads at once."""
+        bucket = self._thread_bucket(bucketname)
+        return [(key.name, key.size, key.etag,
+                 archivelib.parse_timestamp(key.last_modified))
+                for key in bucket.list()]
+
+    def _store_listing(self, bucket, keys):
+        "Saves a fresh listing of a bucket for _bucket_keys"
+        self._listed.add(bucket.name)
+        if self._catalog is not None:
+            self._catalog.refresh_bucket(bucket.name, keys)
+        else:
+            self._listings[bucket.name] = keys
+
+    def _bucket_keys(self, bucket):
+        """Returns a list of (name, size, etag, last_modified) for the keys in
+           a bucket, from the catalog unless it is stale or a refresh of
+           it was asked for."""
+        if self._needs_listing(bucket):
+            self._store_listing(bucket, self._fetch_listing(bucket.name))
+        if self._catalog is not None:
+            return self._catalog.keys(bucket.name)
+        return self._listings[bucket.name]
+
     def _list_backups(self, bucket):
         """Returns a dict of backups in a bucket, with dicts of:
         {hostname (str):
@@ -69,7 +145,10 @@ class BackupManager:
                  'keys': A list of keys comprising the backup,
                  'hostname': Hostname (str),
                  'backupnum': Backup number (int),
-                 'finalized': 0, or the timestamp the backup was finalized
+                 'finalized': 0, or the timestamp the backup was finalized,
+                 'manifestkey': The backup's MANIFEST key, or None,
+                 'indexkey': The backup's INDEX key, or None,
+                 'bucket': The bucket holding the backup
                 }
             }
         }
@@ -77,33 +156,22 @@ class BackupManager:
 
         backups = {}
 
-        for key in bucket.list():
-            keyparts = key.key.split('.')
-            final = False
-
-            if keyparts[-1] == 'COMPLETE':
-                final = True
-                keyparts.pop() # back to tar
-                keyparts.pop() # back to backup number
-            else:
-                if keyparts[-1] == 'gpg':
-                    keyparts.pop()
-
-                if keyparts[-1] != 'tar' and len(keyparts[-1]) is 2:
-                    keyparts.pop()
-
-                if keyparts[-1] == 'tar':
-                    keyparts.pop()
-
-            nextpart = keyparts.pop()
-            if nextpart == 'COMPLETE':
-                print("Stray file: %s" % key.key)
+        for name, size, etag, last_modified in self._bucket_keys(bucket):
+            keyinfo = archivelib.parse_key(name)
+            if keyinfo is None:
+                print("Stray file: %s" % name)
                 continue
-            backupnum = int(nextpart)
-            hostname = '.'.join(keyparts)
+            if keyinfo['hostname'] is None:
+                # a deduplicated chunk, found through its backups' manifests
+                continue
+            final = keyinfo['final']
+            backupnum = keyinfo['backupnum']
+            hostname = keyinfo['hostname']
 
-            lastmod = time.strptime(key.last_modified,
-                                    '%Y-%m-%dT%H:%M:%S.000Z')
+            key = bucket.new_key(name)
+            key.size = size
+            key.etag = etag
+            lastmod = time.gmtime(last_modified)
 
             if hostname in backups.keys():
                 if not backupnum in backups[hostname].keys():
@@ -115,6 +183,9 @@ class BackupManager:
                         'keys': [],
                         'finalkey': None,
                         'finalized_age': -1,
+                        'manifestkey': None,
+                        'indexkey': None,
+                        'bucket': bucket,
                     }
             else:
                 backups[hostname] = {
@@ -126,6 +197,9 @@ class BackupManager:
                         'keys': [],
                         'finalkey': None,
                         'finalized_age': -1,
+                        'manifestkey': None,
+                        'indexkey': None,
+                        'bucket': bucket,
                     }
                 }
             if final:
@@ -137,7 +211,12 @@ class BackupManager:
             else:
                 if lastmod < backups[hostname][backupnum]['date']:
                     backups[hostname][backupnum]['date'] = lastmod
-                backups[hostname][backupnum]['keys'].append(key)
+                if keyinfo['manifest']:
+                    backups[hostname][backupnum]['manifestkey'] = key
+                elif keyinfo['index']:
+                    backups[hostname][backupnum]['indexkey'] = key
+                else:
+                    backups[hostname][backupnum]['keys'].append(key)
         return backups
 
     def get_backups_by_bucket(self, bucket):
@@ -146,16 +225,43 @@ class BackupManager:
 
         return self._bucketbackups[bucket.name]
 
+    def _list_buckets(self, buckets):
+        """Lists the buckets that need it from S3, several at a time, since
+           the time goes on round trips rather than work."""
+        stale = [b for b in buckets if self._needs_listing(b)]
+        if not stale:
+            return
+
+        pool = ThreadPool(max(1, min(self._threads, len(stale))))
+        try:
+            listings = pool.imap(self._fetch_listing, [b.name for b in stale])
+            for bucket, keys in zip(stale, listings):
+                self._store_listing(bucket, keys)
+                sys.stderr.write('.')
+                sys.stderr.flush()
+        finally:
+            pool.terminate()
+
+    def _merge_host(self, hostname):
+        "Rebuilds one host's entry in self._backups from the bucket listings"
+        merged = {}
+        for bucketbackups in self._bucketbackups.values():
+            merged.update(bucketbackups.get(hostname, {}))
+        if merged:
+            self._backups[hostname] = merged
+        else:
+            self._backups.pop(hostname, None)
+
     @property
     def all_backups(self):  # property
         if self._backups is None:
             sys.stderr.write("Enumerating backups")
+            self._list_buckets([b for b in self.backup_buckets
+                                if b.name not in self._bucketbackups])
             self._backups = {}
             for bucket in self.backup_buckets:
                 backups_dict = self.get_backups_by_bucket(bucket)
                 for hostname, backups in backups_dict.items():
-                    sys.stderr.write('.')
-                    sys.stderr.flush()
                     if hostname not in self._backups:
                         self._backups[hostname] = {}
                     self._backups[hostname].update(backups)
@@ -163,15 +269,571 @@ class BackupManager:
         return self._backups
 
     def invalidate_host_cache(self, hostname):
-        nuke = []
-        for bucket in self._bucketbackups:
-            if hostname in self._bucketbackups[bucket]:
-                nuke.append(bucket)
+        "Lists the buckets holding hostname's backups again, and only those"
+        for bucket in self.backup_buckets:
+            bucketbackups = self._bucketbackups.get(bucket.name)
+            if bucketbackups is None or hostname not in bucketbackups:
+                continue
+
+            # The catalog already has this tool's deletions; without one,
+            # go back to S3.
+            if self._catalog is None:
+                self._listed.discard(bucket.name)
+            del self._bucketbackups[bucket.name]
+
+            hosts = set(bucketbackups) | set(self.get_backups_by_bucket(bucket))
+            if self._backups is not None:
+                for host in hosts:
+                    self._merge_host(host)
+
+    def deletion_plan(self, backup, deleting=()):
+        """Returns the names of a backup's keys in the order they must be
+           deleted, as a list of phases: the COMPLETE marker goes first, so a
+           half-deleted backup never looks finalized, then the chunks, then
+           the MANIFEST, so an interrupted delete can still find the shared
+           chunks only this backup refers to.  deleting is every backup
+           being deleted in the same sweep (see unreferenced_chunks)."""
+        phases = []
+        if backup['finalkey'] is not None:
+            phases.append([backup['finalkey'].name])
+        chunks = [key.name for key in backup['keys']]
+        chunks += [key.name for key in self.unreferenced_chunks(backup, deleting)]
+        if backup['indexkey'] is not None:
+            chunks.append(backup['indexkey'].name)
+        if chunks:
+            phases.append(chunks)
+        if backup['manifestkey'] is not None:
+            phases.append([backup['manifestkey'].name])
+        return phases
+
+    def _delete_names(self, bucketname, names, retries=5):
+        """Deletes keys with multi-object delete requests, retrying the keys
+           that fail.  Returns (deleted names, {name: error}) for the keys
+           that were and weren't deleted."""
+        bucket = self._thread_bucket(bucketname)
+        deleted = []
+        errors = {}
+        pending = list(names)
+
+        for retry_count in range(retries + 1):
+            if retry_count > 0:
+                sleeptime = 2**retry_count
+                sys.stderr.write('%s: %i keys not deleted, retrying in %i '
+                                 'seconds (%i/%i)\n' % (bucketname,
+                                 len(pending), sleeptime, retry_count,
+                                 retries))
+                time.sleep(sleeptime)
+
+            failed = []
+            for i in range(0, len(pending), DELETE_BATCH):
+                batch = pending[i:i + DELETE_BATCH]
+                try:
+                    result = bucket.delete_keys(batch, quiet=True)
+                except (boto.exception.S3ResponseError, socket.error), e:
+                    for name in batch:
+                        errors[name] = str(e)
+                    failed.extend(batch)
+                    continue
+
+                # in quiet mode, S3 only reports the keys it couldn't delete
+                bad = set()
+                for error in result.errors:
+                    errors[error.key] = '%s: %s' % (error.code, error.message)
+                    bad.add(error.key)
+                for name in batch:
+                    if name in bad:
+                        failed.append(name)
+                    else:
+                        deleted.append(name)
+            pending = failed
+            if not pending:
+                break
+
+        return deleted, dict((name, errors[name]) for name in pending)
+
+    def _delete_phases(self, args):
+        """Deletes a backup's keys phase by phase (see deletion_plan),
+           stopping at the first phase that doesn't completely go."""
+        backup, phases, retries = args
+        deleted = []
+        errors = {}
+        for phase in phases:
+            done, errors = self._delete_names(backup['bucket'].name, phase,
+                                              retries)
+            deleted.extend(done)
+            if errors:
+                break
+        return backup, deleted, errors
+
+    def _forget_deleted(self, backup, deleted):
+        "Drops deleted keys from the catalog, in this (the catalog's) thread"
+        if self._catalog is not None and deleted:
+            self._catalog.delete_keys(backup['bucket'].name, deleted)
+
+    def delete_backups(self, backups, threads=8, retries=5):
+        """Deletes backups, several at a time.  Every backup's COMPLETE
+           marker goes before any of the chunks do, since a chunk only the
+           backups in the sweep share goes with one of them, and none of the
+           others may still look finalized without it.  A backup whose
+           marker won't go is left out of the sweep, and keeps the chunks it
+           refers to.  Yields (backup, deleted names, {name: error}) as each
+           finishes; a backup with errors was only partly deleted."""
+        if not backups:
+            return
+
+        pool = ThreadPool(max(1, min(threads, len(backups))))
+        try:
+            unfinalized = {}
+            for backup, deleted, errors in pool.imap_unordered(
+                    self._delete_phases,
+                    [(backup, [[backup['finalkey'].name]], retries)
+                     for backup in backups if backup['finalkey'] is not None]):
+                self._forget_deleted(backup, deleted)
+                if errors:
+                    yield backup, deleted, errors
+                else:
+                    unfinalized[id(backup)] = deleted
+
+            # in the sweep's own order, which decides who takes shared chunks
+            going = [backup for backup in backups
+                     if backup['finalkey'] is None or id(backup) in unfinalized]
+            plans = []
+            for backup in going:
+                phases = self.deletion_plan(backup, going)
+                if backup['finalkey'] is not None:
+                    phases = phases[1:]
+                plans.append((backup, phases, retries))
+
+            for backup, deleted, errors in pool.imap_unordered(
+                    self._delete_phases, plans):
+                self._forget_deleted(backup, deleted)
+                if not errors:
+                    self.forget_backup(backup)
+                yield (backup, unfinalized.get(id(backup), []) + deleted,
+                       errors)
+        finally:
+            pool.terminate()
+
+    def forget_backup(self, backup):
+        "Drops a (deleted) backup from the cached listings"
+        for backups in [self.all_backups,
+                        self.get_backups_by_bucket(backup['bucket'])]:
+            backups.get(backup['hostname'], {}).pop(backup['backupnum'], None)
+
+    def get_manifest(self, backup):
+        "Returns a backup's parsed MANIFEST, or None if it has none"
+        key = backup.get('manifestkey')
+        if key is None:
+            return None
+        cachekey = (key.bucket.name, key.name)
+        if cachekey not in self._manifests:
+            body = None
+            if self._catalog is not None:
+                body = self._catalog.get_manifest(key.bucket.name, key.name,
+                                                  key.etag)
+            if body is None:
+                body = key.get_contents_as_string()
+                if self._catalog is not None:
+                    self._catalog.put_manifest(key.bucket.name, key.name,
+                                               key.etag, body)
+            self._manifests[cachekey] = json.loads(body)
+        return self._manifests[cachekey]
+
+    def _fetch_manifest(self, key):
+        "Downloads a MANIFEST; safe to call from several threads at once"
+        return self._thread_bucket(key.bucket.name).new_key(
+            key.name).get_contents_as_string()
+
+    def prefetch_manifests(self, backups):
+        """Downloads the MANIFESTs of backups that get_manifest doesn't have
+           yet, several at a time."""
+        wanted = []
+        for backup in backups:
+            key = backup.get('manifestkey')
+            if key is None or (key.bucket.name, key.name) in self._manifests:
+                continue
+            if self._catalog is not None and self._catalog.get_manifest(
+                    key.bucket.name, key.name, key.etag) is not None:
+                continue
+            wanted.append(key)
+        if not wanted:
+            return
+
+        pool = ThreadPool(max(1, min(self._threads, len(wanted))))
+        try:
+            for key, body in zip(wanted, pool.imap(self._fetch_manifest,
+                                                   wanted)):
+                # the catalog belongs to this thread
+                if self._catalog is not None:
+                    self._catalog.put_manifest(key.bucket.name, key.name,
+                                               key.etag, body)
+                self._manifests[(key.bucket.name, key.name)] = json.loads(body)
+        finally:
+            pool.terminate()
+
+    def get_index(self, backup, passphrase=None):
+        """Returns a backup's parsed INDEX of tar members, or None if it has
+           none (it was archived before there were indexes)"""
+        key = backup.get('indexkey')
+        if key is None:
+            return None
+        body = key.get_contents_as_string()
+        if body[:2] != archivelib.GZIP_MAGIC:
+            body = decrypt_string(body, passphrase, key.name)
+        return json.load(gzip.GzipFile(fileobj=StringIO(body)))
+
+    def chunk_keys(self, backup):
+        "Returns the keys to fetch, in order, to reassemble a backup"
+        manifest = self.get_manifest(backup)
+        if manifest is None:
+            return backup['keys']
+        return [backup['bucket'].new_key(chunk['key'])
+                for chunk in manifest['chunks']]
+
+    def _restore_chunk(self, args):
+        """Downloads one chunk into scratchdir, retrying until it comes down
+           whole, and decodes it in the process pool.  A whole chunk that
+           won't decode won't on a second try either, so that isn't retried.
+           Returns the name of the file holding the chunk's piece of the tar
+           stream."""
+        key, index, scratchdir, passphrase, procpool, retries, throttle = args
+        filename = os.path.join(scratchdir, '%06i.%s' % (index,
+                                os.path.basename(key.name)))
+
+        callback = None
+        if throttle is not None:
+            counted = [0]
+
+            def callback(sofar, total):
+                if sofar - counted[0] >= 1048576 or sofar == total:
+                    throttle.consume(sofar - counted[0])
+                    counted[0] = sofar
+
+        error = None
+        for retry_count in range(retries + 1):
+            if retry_count > 0:
+                sleeptime = 2**retry_count
+                sys.stderr.write('%s: %s, retrying in %i seconds '
+                                 '(%i/%i)\n' % (key.name, error, sleeptime,
+                                 retry_count, retries))
+                time.sleep(sleeptime)
+
+            try:
+                bucket = self._thread_bucket(key.bucket.name)
+                download = bucket.new_key(key.name)
+                download.get_contents_to_filename(filename, cb=callback,
+                                                  num_cb=-1)
+                if os.path.getsize(filename) == download.size:
+                    break
+                error = 'got %i of %i bytes' % (os.path.getsize(filename),
+                                                download.size)
+            except (boto.exception.S3ResponseError, socket.error,
+                    IOError), e:
+                error = str(e)
+            if os.path.exists(filename):
+                os.unlink(filename)
+        else:
+            raise RuntimeError('could not download %s: %s' % (key.name,
+                                                              error))
+
+        try:
+            return procpool.apply(decode_chunk,
+                                  ((filename, key.name, passphrase),))
+        finally:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def restore_backup(self, backup, destination, passphrase=None,
+                       threads=4, processes=None, window=8, retries=5,
+                       pieces=None):
+        """Extracts a backup into destination without ever putting the whole
+           archive on disk.  Chunks are downloaded threads at a time and
+           decoded in a pool of processes, and each is fed to tar as soon as
+           the ones before it have been; no more than window chunks are
+           held in scratch space (under destination) at once.  pieces, from
+           index_pieces, limits this to some chunks, and to byte ranges of
+           them.  Yields (chunks done, chunks in all, bytes extracted) as
+           each goes in."""
+        keys = self.chunk_keys(backup)
+        if pieces is None:
+            pieces = [(number, None) for number in range(len(keys))]
+        window = max(1, window)
+        scratchdir = tempfile.mkdtemp(prefix='.restore-scratch-',
+                                      dir=destination)
+        procpool = Pool(processes or cpu_count())
+        pool = ThreadPool(max(1, min(threads, len(pieces))))
+        tar = Popen(['tar', '-xf', '-', '-C', destination], stdin=PIPE)
+
+        pending = {}
+        extracted = 0
+        try:
+            for index in range(len(pieces)):
+                # keep the next window chunks on their way while tar works
+                # through this one
+                for ahead in range(index, min(index + window, len(pieces))):
+                    if ahead not in pending:
+                        number = pieces[ahead][0]
+                        pending[ahead] = pool.apply_async(
+                            self._restore_chunk, ((keys[number], number,
+                                scratchdir, passphrase, procpool, retries,
+                                None),))
+
+                plainfile = pending.pop(index).get()
+                number, spans = pieces[index]
+                try:
+                    infp = open(plainfile, 'rb')
+                    try:
+                        if spans is None:
+                            shutil.copyfileobj(infp, tar.stdin, 1048576)
+                            extracted += infp.tell()
+                        for start, end in spans or []:
+                            infp.seek(start)
+                            while start < end:
+                                data = infp.read(min(end - start, 1048576))
+                                if not data:
+                                    raise RuntimeError('%s is shorter than '
+                                        'its index says' % keys[number].name)
+                                tar.stdin.write(data)
+                                start += len(data)
+                                extracted += len(data)
+                    finally:
+                        infp.close()
+                    if spans is not None and index == len(pieces) - 1:
+                        # the members were cut out of the archive without
+                        # its end-of-archive blocks
+                        tar.stdin.write('\0' * 1024)
+                except IOError, e:
+                    if e.errno != errno.EPIPE:
+                        raise
+                    break   # tar has quit; its exit status says why
+                finally:
+                    os.unlink(plainfile)
+                yield index + 1, len(pieces), extracted
+        finally:
+            pool.terminate()
+            procpool.terminate()
+            try:
+                tar.stdin.close()
+            except IOError:
+                pass
+            tar.wait()
+            shutil.rmtree(scratchdir, ignore_errors=True)
+
+        if tar.returncode != 0:
+            raise RuntimeError('tar exited with status %i' % tar.returncode)
+
+    def unreferenced_chunks(self, backup, deleting=()):
+        """Returns the keys of a deduplicated backup's chunks that no other
+           backup in its bucket refers to, and so can go when it does.
+           deleting is a list of every backup being deleted in the same
+           sweep: their references don't count, and a chunk only they share
+           goes with the first of them that refers to it."""
+        manifest = self.get_manifest(backup)
+        if manifest is None or not manifest.get('dedup'):
+            return []
+
+        order = dict([(id(other), i) for i, other in enumerate(deleting)])
+        inuse = set()
+        for backups in self.get_backups_by_bucket(backup['bucket']).values():
+            for other in backups.values():
+                if other is backup:
+                    continue
+                if id(other) in order and (id(backup) not in order or
+                                           order[id(other)] > order[id(backup)]):
+                    continue    # going too, and not taking these with it
+                othermanifest = self.get_manifest(other)
+                if othermanifest is not None and othermanifest.get('dedup'):
+                    inuse.update([c['key'] for c in othermanifest['chunks']])
+
+        mine = set([chunk['key'] for chunk in manifest['chunks']])
+        return [backup['bucket'].new_key(name)
+                for name in sorted(mine - inuse)]
+
+    def check_backup(self, backup, listing):
+        """Checks a backup's chunks against listing, a dict of name to (size,
+           etag) for its bucket, without downloading any of them.  Returns a
+           list of the problems found."""
+        problems = []
+        manifest = self.get_manifest(backup)
+        if manifest is None:
+            # an older backup: split's chunks, which must run aa, ab, ...
+            names = sorted([key.name for key in backup['keys']])
+            suffixes = archivelib.split_suffixes()
+            for name in names:
+                chunk = archivelib.parse_key(name)['chunk']
+                if chunk is None and len(names) == 1:
+                    break
+                expected = suffixes.next()
+                if chunk != expected:
+                    problems.append('chunk %s is missing, found %s instead' % (
+                                    expected, name))
+                    break
+            if not names:
+                problems.append('no chunks')
+        else:
+            for chunk in manifest['chunks']:
+                if chunk['key'] not in listing:
+                    problems.append('%s is missing' % chunk['key'])
+                    continue
+                if manifest.get('dedup'):
+                    # these sizes are of the chunk before it was encoded
+                    continue
+                size, etag = listing[chunk['key']]
+                if size != chunk['size']:
+                    problems.append('%s is %i bytes, not %i' % (
+                                    chunk['key'], size, chunk['size']))
+                elif (chunk.get('etag') and etag
+                        and etag.strip('"') != chunk['etag'].strip('"')):
+                    problems.append('%s has ETag %s, not %s' % (
+                                    chunk['key'], etag, chunk['etag']))
+            if not manifest.get('dedup'):
+                inmanifest = set([chunk['key'] for chunk in manifest['chunks']])
+                for key in backup['keys']:
+                    if key.name not in inmanifest:
+                        problems.append('%s is not in the MANIFEST' % key.name)
+            if not manifest['chunks']:
+                problems.append('no chunks')
+
+        if manifest is None or manifest.get('dedup'):
+            for name in sorted(set([key.name for key in
+                                    self.chunk_keys(backup)])):
+                if name in listing and listing[name][0] == 0:
+                    problems.append('%s is empty' % name)
+        return problems
+
+    def _verify_chunk(self, args):
+        """Downloads and decodes one chunk, and checks it is the size the
+           backup's index says, with a tar header at each member's offset.
+           Returns (number, problem or None)."""
+        (key, number, size, offsets, scratchdir, passphrase, procpool,
+         retries, throttle) = args
+        try:
+            plainfile = self._restore_chunk((key, number, scratchdir,
+                            passphrase, procpool, retries, throttle))
+        except RuntimeError, e:
+            return number, str(e)
 
-        for bucket in nuke:
-            if bucket in self._bucketbackups:
-                del self._bucketbackups[bucket]
-                self._backups = None
+        try:
+            if size is not None and os.path.getsize(plainfile) != size:
+                return number, '%s holds %i bytes of tar, not %i' % (
+                               key.name, os.path.getsize(plainfile), size)
+            fp = open(plainfile, 'rb')
+            try:
+                for offset in offsets:
+                    fp.seek(offset)
+                    if not tar_header_ok(fp.read(512)):
+                        return number, '%s has no tar header at %i' % (
+                                       key.name, offset)
+            finally:
+                fp.close()
+        finally:
+            os.unlink(plainfile)
+        return number, None
+
+    def verify_backups(self, backups, deep=False, sample=0.05,
+                       passphrase=None, threads=4, processes=None,
+                       retries=5, bandwidth=None):
+        """Checks backups' chunks against their buckets' listings and
+           MANIFESTs, and with deep, downloads and decodes a random sample of
+           each backup's chunks (a fraction, or a count if 1 or more), threads
+           at a time, downloading no more than bandwidth bytes per second.
+           Yields a dict of {hostname, backupnum, chunks, sampled, problems}
+           for each backup as it is done."""
+        self.prefetch_manifests(backups)
+        listings = {}
+        results = []
+        for backup in backups:
+            bucketname = backup['bucket'].name
+            if bucketname not in listings:
+                listings[bucketname] = dict(
+                    (name, (size, etag)) for name, size, etag, last_modified
+                    in self._bucket_keys(backup['bucket']))
+            keys = self.chunk_keys(backup)
+            results.append({
+                'hostname': backup['hostname'],
+                'backupnum': backup['backupnum'],
+                'chunks': len(keys),
+                'sampled': 0,
+                'problems': self.check_backup(backup, listings[bucketname]),
+            })
+        if not deep:
+            for result in results:
+                yield result
+            return
+
+        throttle = None
+        if bandwidth:
+            throttle = archivelib.Throttle(bandwidth)
+        scratchdir = tempfile.mkdtemp(prefix='backup-manager-verify-')
+        procpool = Pool(processes or cpu_count())
+        pool = ThreadPool(max(1, threads))
+        try:
+            tasks = []
+            for i, backup in enumerate(backups):
+                result = results[i]
+                listing = listings[backup['bucket'].name]
+                keys = self.chunk_keys(backup)
+                try:
+                    index = self.get_index(backup, passphrase)
+                except (RuntimeError, IOError, ValueError), e:
+                    result['problems'].append('INDEX unreadable: %s' % e)
+                    index = None
+                if index is not None and len(index['chunks']) != len(keys):
+                    result['problems'].append('INDEX lists %i chunks, not '
+                                              '%i' % (len(index['chunks']),
+                                                      len(keys)))
+                    index = None
+
+                # each stored chunk once, however many times it is used
+                first = {}
+                for number, key in enumerate(keys):
+                    if key.name in listing:
+                        first.setdefault(key.name, number)
+                numbers = sorted(first.values())
+                if sample < 1:
+                    count = int(ceil(len(numbers) * sample))
+                else:
+                    count = int(sample)
+                numbers = sorted(random.sample(numbers,
+                                               min(count, len(numbers))))
+                result['sampled'] = len(numbers)
+
+                starts = [0]
+                if index is not None:
+                    for size in index['chunks']:
+                        starts.append(starts[-1] + size)
+                    members = sorted([m[1] for m in index['members']])
+                for number in numbers:
+                    size = None
+                    offsets = []
+                    if index is not None:
+                        size = index['chunks'][number]
+                        start = starts[number]
+                        offsets = [offset - start for offset in members[
+                            bisect.bisect_left(members, start):
+                            bisect.bisect_left(members, start + size)]]
+                    elif number == 0:
+                        offsets = [0]
+                    tasks.append((i, (keys[number], number, size, offsets,
+                                      scratchdir, passphrase, procpool,
+                                      retries, throttle)))
+
+            pending = [r['sampled'] for r in results]
+            for i, result in enumerate(results):
+                if not pending[i]:
+                    yield result
+            outcomes = pool.imap_unordered(
+                lambda task: (task[0], self._verify_chunk(task[1])), tasks)
+            for i, (number, problem) in outcomes:
+                if problem is not None:
+                    results[i]['problems'].append(problem)
+                pending[i] -= 1
+                if not pending[i]:
+                    yield results[i]
+        finally:
+            pool.terminate()
+            procpool.terminate()
+            shutil.rmtree(scratchdir, ignore_errors=True)
 
     @property
     def backups_by_age(self):   # property
@@ -238,9 +900,13 @@ def iter_urls(keyset, expire=86400):
         yield key.generate_url(expires_in=expire)
 
 
-def make_restore_script(backup, expire=86400):
+def make_restore_script(backup, expire=86400, keys=None):
     """Returns a quick and easy restoration script to restore the given system,
-       requires a backup, and perhaps expire"""
+       requires a backup, and perhaps expire.  keys, if given, are the keys
+       to join in order (see BackupManager.chunk_keys)"""
+
+    if keys is None:
+        keys = backup['keys']
 
     myhostname = backup['hostname']
     mybackupnum = backup['backupnum']
@@ -280,10 +946,16 @@ def make_restore_script(backup, expire=86400):
     output.append('# retrieve files\n')
 
     mysortedfilelist = []
-    for key in backup['keys']:
-        output.append('wget -O $1/.restorescript-scratch/%s "%s"\n' % (
-                        key.name, key.generate_url(expires_in=expire)))
-        mysortedfilelist.append('.restorescript-scratch/' + key.name)
+    myjoinlist = []
+    for key in keys:
+        filename = '.restorescript-scratch/' + os.path.basename(key.name)
+        myjoinlist.append((filename, archivelib.parse_key(key.name)['codec']))
+        if filename in mysortedfilelist:
+            # deduplicated chunks can appear more than once
+            continue
+        output.append('wget -O $1/%s "%s"\n' % (
+                        filename, key.generate_url(expires_in=expire)))
+        mysortedfilelist.append(filename)
     mysortedfilelist.sort()
 
     output.append('\n# decrypt files\n')
@@ -292,14 +964,166 @@ def make_restore_script(backup, expire=86400):
     output.append('\nEOF\n')
 
     output.append('\n# join and untar files\n')
-    output.append('cat .restorescript-scratch/*.tar.?? | tar -xf -\n\n')
+    if any([codec for name, codec in myjoinlist]) or keys is not backup['keys']:
+        # chunks may use different codecs (or none), and deduplicated chunks
+        # don't sort into order, so undo and join each in turn
+        output.append('(\n')
+        for filename, codec in myjoinlist:
+            if filename.endswith('.gpg'):
+                filename = filename[:-len('.gpg')]
+            if codec:
+                cmd = list(archivelib.CODECS[codec]['decompress'])
+            else:
+                cmd = ['cat']
+            output.append('    %s %s\n' % (' '.join(cmd), filename))
+        output.append(') | tar -xf -\n\n')
+    else:
+        output.append('cat .restorescript-scratch/*.tar.?? | tar -xf -\n\n')
 
     output.append('echo "DONE!  Have a nice day."\n##\n')
 
     return output
 
 
-def start_archive(hosts):
+def decrypt_string(data, passphrase, name):
+    "Returns gpg-encrypted data, decrypted.  name is only for errors."
+    if not passphrase:
+        raise RuntimeError('%s is encrypted, but there is no '
+                           'gpgsymmetrickey' % name)
+    fp = tempfile.NamedTemporaryFile()
+    try:
+        fp.write(data)
+        fp.flush()
+        cmd = ['/usr/bin/gpg', '--batch', '--no-tty', '--quiet',
+               '--passphrase-fd', '0', '--output', '-', '--decrypt', fp.name]
+        proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
+        output = proc.communicate(passphrase)[0]
+    finally:
+        fp.close()
+    if proc.returncode != 0:
+        raise RuntimeError('%s exited with status %i for %s' % (
+                           cmd[0], proc.returncode, name))
+    return output
+
+
+def tar_header_ok(header):
+    "Returns True if a 512-byte block is a tar header with a good checksum"
+    if len(header) < 512 or header == '\0' * 512:
+        return False
+    try:
+        stored = int(header[148:156].strip(' \0'), 8)
+    except ValueError:
+        return False
+    return stored == sum(map(ord, header[:148] + ' ' * 8 + header[156:]))
+
+
+def tidy_path(path):
+    "Returns a tar member name or path without its leading ./ or /"
+    path = path.rstrip('/')
+    while path.startswith('./'):
+        path = path[2:]
+    return path.lstrip('/')
+
+
+def select_members(members, patterns):
+    """Returns the [name, offset, length] entries, from a backup's INDEX, of
+       the tar members matching any of patterns.  A pattern is a path or a
+       glob; a directory takes everything under it along."""
+    patterns = [tidy_path(pattern) for pattern in patterns]
+    selected = []
+    for member in members:
+        name = tidy_path(member[0])
+        for pattern in patterns:
+            if (fnmatch.fnmatchcase(name, pattern)
+                    or fnmatch.fnmatchcase(name, pattern + '/*')):
+                selected.append(member)
+                break
+    return selected
+
+
+def index_pieces(chunksizes, members):
+    """Maps [name, offset, length] index entries onto the chunks holding
+       them, given the size of each chunk's piece of the tar stream.
+       Returns [(chunk number, [(start, end), ...]), ...] of the byte ranges
+       to take from each chunk that is needed at all, for restore_backup."""
+    spans = []
+    for name, offset, length in sorted(members, key=lambda m: m[1]):
+        if spans and offset <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], offset + length)
+        else:
+            spans.append([offset, offset + length])
+
+    pieces = []
+    chunkstart = 0
+    i = 0
+    for number, size in enumerate(chunksizes):
+        chunkend = chunkstart + size
+        within = []
+        while i < len(spans) and spans[i][0] < chunkend:
+            start, end = spans[i]
+            within.append((max(start, chunkstart) - chunkstart,
+                           min(end, chunkend) - chunkstart))
+            if end > chunkend:
+                break   # the rest is in the next chunk
+            i += 1
+        if within:
+            pieces.append((number, within))
+        chunkstart = chunkend
+    return pieces
+
+
+def decode_chunk(args):
+    """Decrypts and decompresses a downloaded chunk, as its key name says,
+       into filename + '.tar'.  Returns that name.  For restore_backup's
+       process pool."""
+    filename, name, passphrase = args
+    info = archivelib.parse_key(name)
+    output = filename + '.tar'
+
+    if not info['encrypted'] and not info['codec']:
+        os.rename(filename, output)
+        return output
+
+    procs = []
+    infp = open(filename, 'rb')
+    outfp = open(output, 'wb')
+    try:
+        stdin = infp
+        if info['encrypted']:
+            if not passphrase:
+                raise RuntimeError('%s is encrypted, but there is no '
+                                   'gpgsymmetrickey' % name)
+            cmd = ['/usr/bin/gpg', '--batch', '--no-tty', '--quiet',
+                   '--passphrase-fd', '0', '--output', '-',
+                   '--decrypt', filename]
+            proc = Popen(cmd, stdin=PIPE,
+                         stdout=PIPE if info['codec'] else outfp)
+            proc.stdin.write(passphrase)
+            proc.stdin.close()
+            procs.append((cmd[0], proc))
+            stdin = proc.stdout
+        if info['codec']:
+            cmd = archivelib.decompress_command(info['codec'])
+            procs.append((cmd[0], Popen(cmd, stdin=stdin, stdout=outfp)))
+            if stdin is not infp:
+                stdin.close()
+
+        for cmdname, proc in procs:
+            proc.wait()
+            if proc.returncode != 0:
+                raise RuntimeError('%s exited with status %i for %s' % (
+                                   cmdname, proc.returncode, name))
+    except:
+        outfp.close()
+        os.unlink(output)
+        raise
+    finally:
+        infp.close()
+    outfp.close()
+    return output
+
+
+def start_archive(hosts, archivehost='archives3'):
     "Starts an archive operation for a list of hosts."
     if 'LOGNAME' in os.environ:
         username = os.environ['LOGNAME']
@@ -311,7 +1135,7 @@ def start_archive(hosts):
 
     scriptdir = os.path.dirname(sys.argv[0])
 
-    cmd = [os.path.join(scriptdir, 'BackupPC_archiveStart'), 'archives3',
+    cmd = [os.path.join(scriptdir, 'BackupPC_archiveStart'), archivehost,
            username]
     cmd.extend(hosts)
 
@@ -319,16 +1143,151 @@ def start_archive(hosts):
     proc.communicate()
 
 
+class FleetScheduler:
+    """Keeps an archive job going on each of several BackupPC archive hosts
+       at once, working through the hosts in choose_host_to_backup order,
+       and splits the fleet's CPU, bandwidth and scratch budgets evenly
+       between the jobs.  The archiver reads its share from a budget file,
+       and reports back through a status file.
+
+       The sweep is kept in schedule.json in the state directory, so an
+       interrupted one picks up where it left off."""
+
+    def __init__(self, archivehosts, statedir=None, cpus=None, bandwidth=None,
+                 scratch=None, start_timeout=3600):
+        self.archivehosts = archivehosts
+        self.statedir = statedir
+        self.start_timeout = start_timeout
+
+        if cpus is None:
+            try:
+                cpus = cpu_count()
+            except NotImplementedError:
+                cpus = 1
+        jobs = len(archivehosts)
+        self.budget = {'cpus': max(1, cpus // jobs)}
+        if bandwidth:
+            self.budget['bandwidth'] = bandwidth // jobs
+        if scratch:
+            self.budget['scratch'] = scratch // jobs
+
+        self._statefile = os.path.join(archivelib.state_dir(statedir),
+                                       'schedule.json')
+        try:
+            self.state = json.load(open(self._statefile))
+        except (IOError, ValueError):
+            self.state = {'pending': [], 'running': {}, 'finished': {}}
+
+    def save(self):
+        fd = open(self._statefile + '.tmp', 'w')
+        json.dump(self.state, fd)
+        fd.close()
+        os.rename(self._statefile + '.tmp', self._statefile)
+
+    @property
+    def idle(self):     # property
+        "True if the sweep has nothing left to start or wait for"
+        return not self.state['pending'] and not self.state['running']
+
+    def plan(self, agedict, target_count=2):
+        "Starts a new sweep of the hosts that choose_host_to_backup picks"
+        self.state = {
+            'pending': [candidate for candidate, score in
+                        choose_host_to_backup(agedict, target_count)
+                        if score > 0],
+            'running': {},
+            'finished': {},
+        }
+        self.save()
+
+    def job_state(self, job):
+        "Returns 'running', 'complete' or 'failed' for a job we started"
+        status = archivelib.read_job(self.statedir, job['hostname'], 'status')
+        if status is None or status.get('started', 0) < job['started']:
+            # BackupPC hasn't got around to running it yet
+            if time.time() - job['started'] > self.start_timeout:
+                return 'failed'
+            return 'running'
+
+        if status['state'] == 'complete':
+            return 'complete'
+
+        try:
+            os.kill(status['pid'], 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return 'failed'
+        return 'running'
+
+    def step(self):
+        """Reaps finished jobs, and starts the next hosts on the archive
+           hosts that are free.  Returns (hostname, what happened) for each
+           job that finished or started."""
+        events = []
+
+        for archivehost, job in sorted(self.state['running'].items()):
+            state = self.job_state(job)
+            if state == 'running':
+                continue
+            del self.state['running'][archivehost]
+            self.state['finished'][job['hostname']] = state
+            try:
+                os.unlink(archivelib.job_file(self.statedir, job['hostname'],
+                                              'budget'))
+            except OSError:
+                pass
+            events.append((job['hostname'], state))
+        self.save()
+
+        for archivehost in self.archivehosts:
+            if not self.state['pending']:
+                break
+            if archivehost in self.state['running']:
+                continue
+            hostname = self.state['pending'].pop(0)
+            archivelib.write_job(self.statedir, hostname, 'budget',
+                                 self.budget)
+            self.state['running'][archivehost] = {'hostname': hostname,
+                                                  'started': time.time()}
+            self.save()
+            start_archive([hostname], archivehost)
+            events.append((hostname, 'started on %s' % archivehost))
+
+        return events
+
+    def run(self, poll=60):
+        "Steps through the sweep until every job has finished"
+        while True:
+            for hostname, event in self.step():
+                sys.stdout.write('%s: %s (%d pending, %d running)\n' % (
+                    hostname, event, len(self.state['pending']),
+                    len(self.state['running'])))
+                sys.stdout.flush()
+            if self.idle:
+                break
+            time.sleep(poll)
+
+
 def main():
     # check command line options
     parser = optparse.OptionParser(
-        usage="usage: %prog [options] [list|delete|script]",
+        usage="usage: %prog [options] " +
+              "[list|delete|script|restore|extract PATH...|verify [HOST...]" +
+              "|schedule]",
         description="" +
             "Companion maintenance script for BackupPC_archiveHost_s3. " +
             "By default, it assumes the 'list' command, which displays all " +
             "of the backups currently archived on S3.  The 'delete' command " +
             "is used to delete backups.  The 'script' command produces a " +
-            "script that can be used to download and restore a backup.")
+            "script that can be used to download and restore a backup.  " +
+            "The 'restore' command restores one itself, into the empty " +
+            "--destination directory, and 'extract' restores only the " +
+            "files matching the paths or globs given, fetching only the " +
+            "chunks that hold them.  The 'verify' command checks that " +
+            "finalized backups are all there, and with --deep, that a " +
+            "sample of their chunks decrypt.  " +
+            "The 'schedule' command archives every host that needs it, " +
+            "several at a time.")
     parser.add_option("-H", "--host", dest="host",
                       help="Name of backed-up host")
     parser.add_option("-b", "--backup-number", dest="backupnum",
@@ -337,9 +1296,12 @@ def main():
                       help="Delete backups older than AGE days")
     parser.add_option("-k", "--keep", dest="keep",
                       help="When used with --age, keep this many recent " +
-                           "backups (default=1)", default=1)
+                           "backups; schedule archives hosts with fewer " +
+                           "than keep+1 (default=1)", default=1)
     parser.add_option("-f", "--filename", dest="filename",
                       help="Output filename for script")
+    parser.add_option("-d", "--destination", dest="destination",
+                      help="Empty directory to restore into")
     parser.add_option("-x", "--expire", dest="expire",
                       help="Maximum age of script, default 86400 seconds")
     parser.add_option("-t", "--test", dest="test", action="store_true",
@@ -352,10 +1314,31 @@ def main():
                            "with fewer than keep+1 backups")
     parser.add_option("-l", "--list", dest="list", action="store_true",
                       help="List stored backups after completing operations")
+    parser.add_option("-r", "--refresh", dest="refresh", action="store_true",
+                      help="Ignore the local catalog and list every bucket")
+    parser.add_option("-D", "--deep", dest="deep", action="store_true",
+                      help="With verify, also download and decrypt a " +
+                           "sample of each backup's chunks")
+    parser.add_option("-o", "--report", dest="report",
+                      help="With verify, write a JSON report to this file")
 
     (options, args) = parser.parse_args()
 
-    bmgr = BackupManager(secrets.accesskey, secrets.sharedkey)
+    catalog = None
+    if getattr(secrets, 'catalog', True):
+        catalog = archivelib.Catalog(getattr(secrets, 'statedir', None),
+                                     getattr(secrets, 'catalog_max_age', 86400))
+
+    # verify checks what is really in S3, not what the catalog remembers,
+    # but only for the hosts it checks
+    refresh = bool(options.refresh)
+    if args[:1] == ['verify'] and not refresh:
+        hosts = args[1:] + [h for h in [options.host] if h]
+        refresh = set((secrets.accesskey + '-bkup-' + h).lower()
+                      for h in hosts) or True
+    bmgr = BackupManager(secrets.accesskey, secrets.sharedkey,
+                         catalog=catalog, refresh=refresh,
+                         threads=getattr(secrets, 'list_threads', 16))
 
     if options.backupnum and not options.host:
         parser.error('Must specify --host when specifying --backup-number')
@@ -366,7 +1349,7 @@ def main():
     if len(args) == 0:
         args.append('list')
 
-    if len(args) > 1:
+    if len(args) > 1 and args[0] not in ['extract', 'verify']:
         parser.error('Too many arguments.')
 
     if args[0] != 'delete' and options.age:
@@ -378,19 +1361,26 @@ def main():
     if args[0] != 'script' and (options.expire or options.filename):
         parser.error('--expire and --filename only make sense with script')
 
-    if args[0] in ['list', 'script', 'delete']:
+    if args[0] not in ['restore', 'extract'] and options.destination:
+        parser.error('--destination only makes sense with restore and extract')
+
+    if args[0] != 'verify' and (options.deep or options.report):
+        parser.error('--deep and --report only make sense with verify')
+
+    if args[0] in ['list', 'script', 'restore', 'extract', 'delete',
+                   'verify']:
         if options.host:
             if options.host not in bmgr.all_backups:
                 parser.error('No backups found for host "%s"' % options.host)
         else:
             if len(bmgr.all_backups) == 0:
                 parser.error('No buckets found!')
-    else:
+    elif args[0] != 'schedule':
         parser.error('Invalid option: %s' + args[0])
 
-    if args[0] == 'script':
+    if args[0] in ['script', 'restore', 'extract']:
         if not options.host:
-            parser.error('Must specify --host to generate a script for')
+            parser.error('Must specify --host with %s' % args[0])
 
         if not options.backupnum and options.unfinalized:
             # assuming highest number
@@ -407,16 +1397,120 @@ def main():
 
         backup = bmgr.all_backups[options.host][options.backupnum]
 
+    if args[0] == 'script':
+        keys = bmgr.chunk_keys(backup)
+
         if not options.expire:
             options.expire = "86400"
 
         if options.filename:
             fd = open(options.filename, 'w')
             fd.writelines(make_restore_script(backup,
-                          expire=int(options.expire)))
+                          expire=int(options.expire), keys=keys))
         else:
             sys.stdout.writelines(make_restore_script(backup,
-                                  expire=int(options.expire)))
+                                  expire=int(options.expire), keys=keys))
+    elif args[0] in ['restore', 'extract']:
+        if not options.destination:
+            parser.error('Must specify --destination to restore to')
+        if not os.path.isdir(options.destination):
+            parser.error('Target %s does not exist!' % options.destination)
+        if os.listdir(options.destination):
+            parser.error('Target %s is not empty!' % options.destination)
+
+        passphrase = getattr(secrets, 'gpgsymmetrickey', None)
+        pieces = None
+        if args[0] == 'extract':
+            if len(args) < 2:
+                parser.error('Must name the files to extract')
+            try:
+                index = bmgr.get_index(backup, passphrase)
+            except RuntimeError, e:
+                parser.error(str(e))
+            if index is None:
+                parser.error('Backup %s %i has no index; use restore' % (
+                             options.host, options.backupnum))
+            if len(index['chunks']) != len(bmgr.chunk_keys(backup)):
+                parser.error('Backup %s %i does not match its index' % (
+                             options.host, options.backupnum))
+            members = select_members(index['members'], args[1:])
+            if not members:
+                parser.error('Nothing in backup %s %i matches %s' % (
+                             options.host, options.backupnum,
+                             ' '.join(args[1:])))
+            pieces = index_pieces(index['chunks'], members)
+            sys.stdout.write('Extracting %i files from %i of %i chunks\n' % (
+                    len(members), len(pieces), len(index['chunks'])))
+
+        sys.stdout.write('Restoring backup: %s %i to %s\n' % (
+                options.host, options.backupnum, options.destination))
+        try:
+            for done, count, extracted in bmgr.restore_backup(backup,
+                    options.destination,
+                    passphrase=passphrase,
+                    pieces=pieces,
+                    threads=getattr(secrets, 'restore_threads', 4),
+                    processes=getattr(secrets, 'restore_processes', None),
+                    window=getattr(secrets, 'restore_window', 8),
+                    retries=getattr(secrets, 'restore_retries', 5)):
+                sys.stdout.write('    %i/%i chunks, %i bytes extracted\n' % (
+                        done, count, extracted))
+                sys.stdout.flush()
+        except RuntimeError, e:
+            sys.stderr.write('Restore failed: %s\n' % e)
+            sys.exit(1)
+        sys.stdout.write('DONE!  Have a nice day.\n')
+    elif args[0] == 'verify':
+        hosts = args[1:]
+        if options.host:
+            hosts.append(options.host)
+        for hostname in hosts:
+            if hostname not in bmgr.all_backups:
+                parser.error('No backups found for host "%s"' % hostname)
+        backups = []
+        for hostname in sorted(hosts or bmgr.all_backups.keys()):
+            for backupnum, backup in sorted(bmgr.all_backups[hostname].items()):
+                if options.backupnum and backupnum != options.backupnum:
+                    continue
+                if backup['finalized'] > 0:
+                    backups.append(backup)
+
+        report = {'started': time.time(), 'deep': bool(options.deep),
+                  'backups': []}
+        failures = 0
+        for result in bmgr.verify_backups(backups, deep=options.deep,
+                sample=getattr(secrets, 'verify_sample', 0.05),
+                passphrase=getattr(secrets, 'gpgsymmetrickey', None),
+                threads=getattr(secrets, 'verify_threads', 4),
+                processes=getattr(secrets, 'restore_processes', None),
+                retries=getattr(secrets, 'restore_retries', 5),
+                bandwidth=getattr(secrets, 'verify_bandwidth', None)):
+            result['ok'] = not result['problems']
+            report['backups'].append(result)
+            if result['ok']:
+                status = 'OK'
+            else:
+                status = 'FAILED'
+                failures += 1
+            detail = '%i chunks' % result['chunks']
+            if options.deep:
+                detail += ', %i decrypted' % result['sampled']
+            sys.stdout.write('%s: %s %i (%s)\n' % (status,
+                    result['hostname'], result['backupnum'], detail))
+            for problem in result['problems']:
+                sys.stdout.write('    %s\n' % problem)
+            sys.stdout.flush()
+
+        report['finished'] = time.time()
+        report['failures'] = failures
+        if options.report:
+            fd = open(options.report, 'w')
+            json.dump(report, fd, indent=1, sort_keys=True)
+            fd.close()
+        sys.stdout.write('%i of %i backups verified\n' % (
+                len(backups) - failures, len(backups)))
+        if failures:
+            sys.exit(1)
     elif args[0] == 'delete':
         to_ignore = int(options.keep)
         to_delete = []
@@ -437,30 +1531,37 @@ def main():
         else:
             parser.error('Need either an age or a host AND backup number.')
 
-        if len(to_delete) > 0:
-            for deletehost, deletebackupnum in to_delete:
-                hostbackups = bmgr.all_backups.get(deletehost, {})
-                deletebackup = hostbackups.get(deletebackupnum, {})
-                deletekeys = deletebackup.get('keys', [])
-                finalkey = deletebackup.get('finalkey', None)
-                if len(deletekeys) > 0:
-                    sys.stdout.write("Deleting backup: %s %d (%d keys)" % (
-                            deletehost, deletebackupnum, len(deletekeys)))
-                    for key in deletekeys:
-                        if options.test:
-                            sys.stdout.write('_')
-                        else:
-                            key.delete()
-                            sys.stdout.write('.')
-                        sys.stdout.flush()
-                    if finalkey is not None:
-                        if options.test:
-                            sys.stdout.write('+')
-                        else:
-                            finalkey.delete()
-                            sys.stdout.write('!')
-                        sys.stdout.flush()
-                    sys.stdout.write('\n')
+        # Every plan knows what else is going, so that chunks only the
+        # backups in this sweep refer to are deleted with them.
+        deleting = []
+        for deletehost, deletebackupnum in to_delete:
+            deletebackup = bmgr.all_backups.get(deletehost, {}).get(deletebackupnum)
+            if deletebackup is not None:
+                deleting.append(deletebackup)
+
+        if options.test:
+            for deletebackup in deleting:
+                phases = bmgr.deletion_plan(deletebackup, deleting)
+                sys.stdout.write("Would delete backup: %s %d (%d keys)\n" % (
+                        deletebackup['hostname'], deletebackup['backupnum'],
+                        sum(map(len, phases))))
+        else:
+            failures = 0
+            for backup, deleted, errors in bmgr.delete_backups(deleting,
+                    threads=getattr(secrets, 'delete_threads', 8),
+                    retries=getattr(secrets, 'delete_retries', 5)):
+                sys.stdout.write("Deleted backup: %s %d (%d keys)\n" % (
+                        backup['hostname'], backup['backupnum'],
+                        len(deleted)))
+                for name, error in sorted(errors.items()):
+                    sys.stdout.write("    could not delete %s: %s\n" % (
+                            name, error))
+                if errors:
+                    failures += 1
+            if failures:
+                sys.stdout.write("%d backups were only partly deleted; "
+                                 "delete them again with --host and "
+                                 "--backup-number to finish\n" % failures)
 
         if options.start:
             for deletehost, deletebackupnum in to_delete:
@@ -473,13 +1574,38 @@ def main():
                                      '%s (score=%g)\n' % (candidate, score))
                     start_archive([candidate])
                     break
+    elif args[0] == 'schedule':
+        scheduler = FleetScheduler(getattr(secrets, 'archive_hosts',
+                                           ['archives3']),
+                        statedir=getattr(secrets, 'statedir', None),
+                        cpus=getattr(secrets, 'fleet_cpus', None),
+                        bandwidth=getattr(secrets, 'fleet_bandwidth', None),
+                        scratch=getattr(secrets, 'fleet_scratch', None),
+                        start_timeout=getattr(secrets, 'schedule_start_timeout',
+                                              3600))
+        if scheduler.idle:
+            scheduler.plan(bmgr.backups_by_age,
+                           target_count=int(options.keep) + 1)
+        else:
+            sys.stdout.write('Resuming sweep: %d pending, %d running\n' % (
+                len(scheduler.state['pending']),
+                len(scheduler.state['running'])))
+        scheduler.run(poll=getattr(secrets, 'schedule_poll', 60))
+
     if args[0] == 'list' or options.list:
         sys.stdout.write('%25s | %5s | %20s | %5s\n' % (
                 "Hostname", "Bkup#", "Age", "Files"))
         sys.stdout.write(('-' * 72) + '\n')
+        # A deduplicated backup's chunks are only counted in its manifest;
+        # the rest were all in the listing.
+        bmgr.prefetch_manifests([backup
+                                 for hostbackups in bmgr.all_backups.values()
+                                 for backup in hostbackups.values()
+                                 if not backup['keys']])
         for hostname, backups in bmgr.all_backups.items():
             for backupnum in sorted(backups.keys()):
-                filecount = len(backups[backupnum]['keys'])
+                filecount = (len(backups[backupnum]['keys']) or
+                             len(bmgr.chunk_keys(backups[backupnum])))
                 datestruct = backups[backupnum]['date']
                 if backups[backupnum]['finalized'] > 0:
                     inprogress = ''
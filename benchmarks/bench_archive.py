@@ -0,0 +1,355 @@
+#!/usr/bin/python
+#
+# Benchmarks BackupPC_archiveHost_s3 against a local stand-in for S3
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Times the archiver's stages one at a time on a synthetic chunk
+(file_digest, compress_file, encrypt_file, and send_file with its
+verify_file against fakes3.py), then a whole archive run: the real script,
+with synthtar.py standing in for BackupPC_tarCreate.  For each, it reports
+MB/s, peak RSS, the scratch disk high-water mark and wall time; the whole
+run's per-stage times come from its metrics file.
+
+Settings for the run go in with --set, as in secrets.py:
+
+    bench_archive.py --size 1G --set compression="'zstd'" --set sending_workers=4
+"""
+
+import glob
+import imp
+import json
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHDIR)
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(1, REPO)
+
+import fakes3
+import synthtar
+
+HOST = 'benchhost'
+MB = 1024.0 * 1024
+
+
+def parse_size(size):
+    "Turns 512K, 64M, 2G and the like into bytes"
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+
+def peak_rss():
+    "Returns the peak RSS, in KB, of this process or any child it waited on"
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class ScratchSampler(threading.Thread):
+    "Keeps the high-water mark of the bytes in a directory"
+
+    def __init__(self, path, interval=0.1):
+        threading.Thread.__init__(self, name='scratch_sampler')
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.highwater = 0
+        self._done = threading.Event()
+
+    def sample(self):
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        self.highwater = max(self.highwater, total)
+
+    def run(self):
+        while not self._done.is_set():
+            self.sample()
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+        return self.highwater
+
+
+def make_secrets(workdir, port, settings):
+    "Returns the secrets.py for a run against the fake S3 on port"
+    config = {
+        'accesskey': 'BENCHACCESSKEY',
+        'sharedkey': 'benchsharedkey',
+        'gpgsymmetrickey': 'benchmark passphrase',
+        's3_host': '127.0.0.1',
+        's3_port': port,
+        's3_secure': False,
+        'statedir': os.path.join(workdir, 'state'),
+    }
+    config.update(settings)
+    return ''.join(['%s = %r\n' % item for item in sorted(config.items())])
+
+
+def load_archiver(secrets_text):
+    "Imports the archiver in this process, with secrets_text as its secrets"
+    config = types.ModuleType('secrets')
+    exec secrets_text in config.__dict__
+    sys.modules['secrets'] = config
+    archiver = imp.load_source('archiver',
+                               os.path.join(REPO, 'BackupPC_archiveHost_s3'))
+    archiver.logger.setLevel(archiver.logging.WARNING)
+    return archiver
+
+
+def write_chunk(filename, size, compressibility):
+    fd = open(filename, 'wb')
+    synthetic = synthtar.SyntheticFile(size, compressibility, 'chunk')
+    for data in iter(lambda: synthetic.read(1048576), ''):
+        fd.write(data)
+    fd.close()
+
+
+def timed(name, nbytes, scratch, function, *args):
+    "Runs function(*args), returning its result and a row for the report"
+    sampler = ScratchSampler(scratch)
+    sampler.start()
+    start = time.time()
+    result = function(*args)
+    seconds = time.time() - start
+    return result, {
+        'stage': name,
+        'bytes': nbytes,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(nbytes / MB / max(seconds, 0.001), 1),
+        'peak_rss_kb': peak_rss(),
+        'scratch_highwater': sampler.stop(),
+    }
+
+
+def bench_stages(workdir, port, options, settings):
+    "Times each stage of the pipeline on one synthetic chunk"
+    archiver = load_archiver(make_secrets(workdir, port, settings))
+    secrets = sys.modules['secrets']
+    scratch = os.path.join(workdir, 'stages')
+    os.makedirs(scratch)
+    chunk = os.path.join(scratch, '%s.1.tar.aa' % HOST)
+    write_chunk(chunk, options.chunk_size, options.compressibility)
+    results = []
+
+    digest, row = timed('file_digest', options.chunk_size, scratch,
+                        archiver.file_digest, chunk)
+    results.append(row)
+
+    for codec in sorted(archiver.archivelib.CODECS):
+        try:
+            (outname, cdigest), row = timed('compress_file (%s)' % codec,
+                                            options.chunk_size, scratch,
+                                            archiver.compress_file, chunk,
+                                            codec)
+        except (OSError, RuntimeError), e:
+            sys.stderr.write('skipping %s: %s\n' % (codec, e))
+            continue
+        row['ratio'] = round(options.chunk_size / float(cdigest['size']), 2)
+        results.append(row)
+        os.unlink(outname)
+
+    (encrypted, edigest), row = timed('encrypt_file', options.chunk_size,
+                                      scratch, archiver.encrypt_file, chunk,
+                                      secrets.gpgsymmetrickey, '/bin/cat')
+    results.append(row)
+
+    bucket = archiver.open_s3(secrets.accesskey, secrets.sharedkey, HOST)
+    ok, row = timed('send_file + verify_file', edigest['size'], scratch,
+                    archiver.send_with_retries, bucket, encrypted, edigest)
+    if not ok:
+        row['stage'] += ' (failed)'
+    results.append(row)
+
+    shutil.rmtree(scratch)
+    return results
+
+
+def bench_pipeline(workdir, port, options, settings):
+    "Times a whole run of the archiver script, as BackupPC would run it"
+    bindir = os.path.join(workdir, 'bin')
+    outloc = os.path.join(workdir, 'archive')
+    os.makedirs(bindir)
+    os.makedirs(outloc)
+
+    # the script imports secrets from its own directory, so it runs from a
+    # copy next to ours
+    for filename in ['BackupPC_archiveHost_s3', 'archivelib.py']:
+        shutil.copy(os.path.join(REPO, filename), bindir)
+    fd = open(os.path.join(bindir, 'secrets.py'), 'w')
+    fd.write(make_secrets(workdir, port, settings))
+    fd.close()
+
+    tarcreate = os.path.join(bindir, 'BackupPC_tarCreate')
+    fd = open(tarcreate, 'w')
+    fd.write('#!/bin/sh\nexec %s %s "$@"\n' % (
+             sys.executable, os.path.join(BENCHDIR, 'synthtar.py')))
+    fd.close()
+    os.chmod(tarcreate, 0755)
+
+    env = dict(os.environ)
+    env.update({
+        'SYNTHTAR_SIZE': str(options.size),
+        'SYNTHTAR_COMPRESSIBILITY': str(options.compressibility),
+        'GNUPGHOME': os.path.join(workdir, 'gnupg'),
+    })
+    cmd = [sys.executable, os.path.join(bindir, 'BackupPC_archiveHost_s3'),
+           tarcreate, '/usr/bin/split', '/bin/true', HOST, '1', '/bin/cat',
+           '.raw', str(options.chunk_size), outloc, '0', '*']
+
+    log = open(os.path.join(workdir, 'archiver.log'), 'w')
+    sampler = ScratchSampler(outloc)
+    sampler.start()
+    start = time.time()
+    returncode = subprocess.call(cmd, env=env, stdout=log,
+                                 stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    highwater = sampler.stop()
+    log.close()
+
+    result = {
+        'stage': 'archive run',
+        'bytes': options.size,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(options.size / MB / max(seconds, 0.001), 1),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'scratch_highwater': highwater,
+        'returncode': returncode,
+    }
+
+    metricsfiles = glob.glob(os.path.join(workdir, 'state', 'metrics',
+                                          '%s.1.*.json' % HOST))
+    if metricsfiles:
+        metrics = json.load(open(sorted(metricsfiles)[-1]))
+        result['compression_ratio'] = metrics['compression_ratio']
+        result['stages'] = metrics['stages']
+        result['queue_depth_max'] = dict(
+            [(qname, max([depth for t, depth in samples] or [0]))
+             for qname, samples in metrics['queues'].items()])
+    return result
+
+
+def report(results, server):
+    sys.stdout.write('%-28s %12s %9s %9s %12s %12s\n' % (
+        'Stage', 'Bytes', 'Seconds', 'MB/s', 'Peak RSS KB', 'Scratch HWM'))
+    sys.stdout.write(('-' * 87) + '\n')
+    for row in results:
+        sys.stdout.write('%-28s %12i %9.2f %9.1f %12i %12i\n' % (
+            row['stage'], row['bytes'], row['seconds'], row['mb_per_s'],
+            row['peak_rss_kb'], row['scratch_highwater']))
+        for stage, totals in sorted(row.get('stages', {}).items()):
+            seconds = totals.get('seconds', 0)
+            nbytes = totals.get('bytes_in', totals.get('bytes',
+                                totals.get('bytes_out', 0)))
+            sys.stdout.write('  %-26s %12i %9.2f %9.1f   (busy seconds, '
+                             'summed over workers)\n' % (
+                             stage, nbytes, seconds,
+                             nbytes / MB / max(seconds, 0.001)))
+    sys.stdout.write('\nFake S3: %i requests, %i injected failures\n' % (
+        server.store.requests, server.store.failures))
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options]",
+        description="Benchmarks BackupPC_archiveHost_s3 against a local " +
+                    "stand-in for S3.")
+    parser.add_option("-s", "--size", dest="size", default="256M",
+                      help="Size of the synthetic tar stream (default=256M)")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", default="32M",
+                      help="ArchiveSplit chunk size (default=32M)")
+    parser.add_option("-z", "--compressibility", dest="compressibility",
+                      type="float", default=0.5,
+                      help="Fraction of the data that compresses away " +
+                           "(default=0.5)")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0, help="Seconds to hold up each S3 request")
+    parser.add_option("-f", "--failure-rate", dest="failure_rate",
+                      type="float", default=0,
+                      help="Fraction of S3 object requests to fail")
+    parser.add_option("--set", dest="settings", action="append", default=[],
+                      metavar="NAME=VALUE",
+                      help="A secrets.py setting for the run (repeatable)")
+    parser.add_option("--stages-only", dest="pipeline", action="store_false",
+                      default=True, help="Skip the whole archive run")
+    parser.add_option("--pipeline-only", dest="stages", action="store_false",
+                      default=True, help="Skip the per-stage benchmarks")
+    parser.add_option("-w", "--workdir", dest="workdir",
+                      help="Scratch directory (default: a temporary one, " +
+                           "removed afterwards)")
+    parser.add_option("-j", "--json", dest="json",
+                      help="Also write the results to this JSON file")
+    (options, args) = parser.parse_args()
+
+    options.size = parse_size(options.size)
+    options.chunk_size = parse_size(options.chunk_size)
+    settings = {}
+    for setting in options.settings:
+        name, _, value = setting.partition('=')
+        settings[name.strip()] = eval(value)
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix='bench-archive-')
+    os.environ['GNUPGHOME'] = os.path.join(workdir, 'gnupg')
+    if not os.path.isdir(os.environ['GNUPGHOME']):
+        os.makedirs(os.environ['GNUPGHOME'], 0700)
+
+    server = fakes3.FakeS3Server(latency=options.latency,
+                                 failure_rate=options.failure_rate,
+                                 store=False).start()
+    results = []
+    try:
+        if options.stages:
+            results.extend(bench_stages(workdir, server.port, options,
+                                        settings))
+        if options.pipeline:
+            results.append(bench_pipeline(workdir, server.port, options,
+                                          settings))
+    finally:
+        server.shutdown()
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    report(results, server)
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=1, sort_keys=True)
+    if [row for row in results if row.get('returncode')]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# Benchmarks backup-manager.py's listings against a local stand-in for S3
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Fills fakes3.py with a synthetic fleet's worth of keys, then times
+BackupManager.all_backups listing it: straight from S3, through a cold
+catalog, and from a warm one; and BackupManager._list_backups on its own,
+over the biggest bucket.
+
+    bench_manager.py --keys 10000,100000,1000000 --hosts 100
+"""
+
+import imp
+import json
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHDIR)
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(1, REPO)
+
+import fakes3
+
+ACCESSKEY = 'BENCHACCESSKEY'
+
+
+def populate(store, keys, hosts, chunks_per_backup):
+    """Spreads keys over hosts' buckets, as backups of chunks_per_backup
+       chunks each, all but the newest finalized"""
+    bucketprefix = ACCESSKEY.lower() + '-bkup-'
+    suffixes = [a + b for a in 'abcdefghijklmnopqrstuvwxy'
+                for b in 'abcdefghijklmnopqrstuvwxyz'][:chunks_per_backup]
+    perhost = max(1, keys // hosts)
+    for h in range(hosts):
+        hostname = 'host%04i' % h
+        bucket = bucketprefix + hostname
+        store.buckets.setdefault(bucket, {})
+        made = 0
+        backupnum = 0
+        while made < perhost:
+            backupnum += 1
+            for suffix in suffixes[:perhost - made]:
+                store.put(bucket, '%s.%i.tar.%s.gpg' % (hostname, backupnum,
+                                                        suffix),
+                          size=524288000, etag='0' * 32)
+                made += 1
+            if made < perhost:
+                store.put(bucket, '%s.%i.tar.COMPLETE' % (hostname,
+                                                          backupnum),
+                          size=80, etag='1' * 32)
+                made += 1
+    return hosts * perhost
+
+
+def load_manager(port):
+    config = types.ModuleType('secrets')
+    config.__dict__.update({
+        'accesskey': ACCESSKEY,
+        'sharedkey': 'benchsharedkey',
+        's3_host': '127.0.0.1',
+        's3_port': port,
+        's3_secure': False,
+    })
+    sys.modules['secrets'] = config
+    return imp.load_source('backup_manager',
+                           os.path.join(REPO, 'backup-manager.py'))
+
+
+def bench(name, nkeys, function):
+    start = time.time()
+    result = function()
+    seconds = time.time() - start
+    return result, {
+        'mode': name,
+        'keys': nkeys,
+        'seconds': round(seconds, 3),
+        'keys_per_s': int(nkeys / max(seconds, 0.001)),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(nkeys, options):
+    server = fakes3.FakeS3Server(latency=options.latency,
+                                 store=False).start()
+    statedir = tempfile.mkdtemp(prefix='bench-manager-')
+    results = []
+    try:
+        nkeys = populate(server.store, nkeys, options.hosts,
+                         options.chunks)
+        bm = load_manager(server.port)
+        archivelib = sys.modules['archivelib']
+
+        def all_backups(catalog, refresh=False):
+            manager = bm.BackupManager(ACCESSKEY, 'benchsharedkey',
+                                       catalog=catalog, refresh=refresh,
+                                       threads=options.threads)
+            return manager, manager.all_backups
+
+        (manager, backups), row = bench('S3 listing', nkeys,
+                                        lambda: all_backups(None))
+        results.append(row)
+        count = sum([len(b) for b in backups.values()])
+
+        catalog = archivelib.Catalog(statedir)
+        (manager, backups), row = bench('catalog, cold', nkeys,
+                                        lambda: all_backups(catalog, True))
+        results.append(row)
+        (manager, backups), row = bench('catalog, warm', nkeys,
+                                        lambda: all_backups(catalog))
+        results.append(row)
+
+        bucket = max(manager.backup_buckets,
+                     key=lambda b: len(server.store.buckets[b.name]))
+        size = len(server.store.buckets[bucket.name])
+        for row in results:
+            row['backups'] = count
+        result, row = bench('_list_backups, one bucket', size,
+                            lambda: manager._list_backups(bucket))
+        row['backups'] = sum([len(b) for b in result.values()])
+        results.append(row)
+    finally:
+        server.shutdown()
+        shutil.rmtree(statedir)
+
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options]",
+        description="Benchmarks backup-manager.py's listings against a " +
+                    "local stand-in for S3.")
+    parser.add_option("-k", "--keys", dest="keys", default="10000,100000",
+                      help="Comma-separated key counts to try " +
+                           "(default=10000,100000)")
+    parser.add_option("-H", "--hosts", dest="hosts", type="int", default=50,
+                      help="Hosts (buckets) to spread the keys over " +
+                           "(default=50)")
+    parser.add_option("-c", "--chunks", dest="chunks", type="int",
+                      default=100, help="Chunks per backup (default=100)")
+    parser.add_option("-t", "--threads", dest="threads", type="int",
+                      default=16, help="Listing threads (default=16)")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0, help="Seconds to hold up each S3 request")
+    parser.add_option("-j", "--json", dest="json",
+                      help="Also write the results to this JSON file")
+    (options, args) = parser.parse_args()
+
+    results = []
+    sys.stdout.write('%-28s %9s %9s %9s %11s %12s\n' % (
+        'Mode', 'Keys', 'Backups', 'Seconds', 'Keys/s', 'Peak RSS KB'))
+    sys.stdout.write(('-' * 83) + '\n')
+    for nkeys in [int(n) for n in options.keys.split(',')]:
+        for row in run(nkeys, options):
+            results.append(row)
+            sys.stdout.write('%-28s %9i %9i %9.2f %11i %12i\n' % (
+                row['mode'], row['keys'], row['backups'], row['seconds'],
+                row['keys_per_s'], row['peak_rss_kb']))
+            sys.stdout.flush()
+
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
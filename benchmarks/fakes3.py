@@ -0,0 +1,414 @@
+#!/usr/bin/python
+#
+# A local stand-in for S3, for benchmarking the archiver and backup-manager.py
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Speaks just enough of the S3 REST API for boto 2 and these scripts:
+bucket listing and creation, object PUT/GET/HEAD/DELETE, multipart
+uploads and multi-object deletes.  Signatures aren't checked.
+
+Every request can be held up by latency seconds, and requests on objects
+fail with a 500 InternalError at failure_rate, to exercise the retries.
+With store=False, only each object's size and ETag are kept, which is
+enough for uploads and listings of more data than fits in memory.
+
+Point the scripts at it with, in secrets.py:
+
+    s3_host = '127.0.0.1'
+    s3_port = 8053
+    s3_secure = False
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import bisect
+import hashlib
+import optparse
+import random
+import threading
+import time
+import urllib
+import urlparse
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+# Listings all claim this date; nothing here depends on it
+LAST_MODIFIED = '2013-01-01T00:00:00.000Z'
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=''):
+        Exception.__init__(self, code)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeS3Store(object):
+    """The buckets and objects behind a FakeS3Server.  Each object is
+       (size, etag, data), where data is None if the store isn't keeping
+       it.  Safe to use from the server's threads."""
+
+    def __init__(self, store=True):
+        self.store = store
+        self.buckets = {}
+        self.uploads = {}
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._next_upload = 0
+        self._sorted = {}
+
+    def put(self, bucket, name, data=None, size=None, etag=None):
+        "Stores an object; size and etag stand in for data if it's None"
+        if data is not None:
+            size = len(data)
+            etag = hashlib.md5(data).hexdigest()
+            if not self.store:
+                data = None
+        with self._lock:
+            self.buckets.setdefault(bucket, {})[name] = (size, etag, data)
+            self._sorted.pop(bucket, None)
+        return etag
+
+    def delete(self, bucket, name):
+        with self._lock:
+            self.buckets.get(bucket, {}).pop(name, None)
+            self._sorted.pop(bucket, None)
+
+    def names(self, bucket):
+        "Returns a bucket's key names in order"
+        with self._lock:
+            if bucket not in self._sorted:
+                self._sorted[bucket] = sorted(self.buckets.get(bucket, {}))
+            return self._sorted[bucket]
+
+    def new_upload(self, bucket, name):
+        with self._lock:
+            self._next_upload += 1
+            upload_id = 'upload-%i' % self._next_upload
+            self.uploads[upload_id] = (bucket, name, {})
+        return upload_id
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # boto keeps its connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_HEAD(self):
+        self._dispatch('HEAD')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        server = self.server
+        store = server.store
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query, keep_blank_values=True))
+        parts = urllib.unquote(path).lstrip('/').split('/', 1)
+        bucket = parts[0]
+        name = len(parts) > 1 and parts[1] or None
+
+        if server.latency:
+            time.sleep(server.latency)
+        store.requests += 1
+
+        try:
+            if name and server.failure_rate and random.random() < server.failure_rate:
+                store.failures += 1
+                raise S3Error(500, 'InternalError', 'injected failure')
+            if not bucket:
+                self._list_buckets()
+            elif name is None:
+                self._bucket(method, bucket, params, body)
+            else:
+                self._object(method, bucket, name, params, body)
+        except S3Error, e:
+            self._send(e.status, '<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<Error><Code>%s</Code><Message>%s</Message></Error>'
+                       % (e.code, escape(e.message)), head=method == 'HEAD')
+
+    def _send(self, status, body='', headers={}, head=False):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body and 'Content-Type' not in headers:
+            self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _xml(self, root, inner):
+        self._send(200, '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<%s xmlns="%s">%s</%s>' % (root, XMLNS, inner, root))
+
+    def _objects(self, bucket):
+        objects = self.server.store.buckets.get(bucket)
+        if objects is None:
+            raise S3Error(404, 'NoSuchBucket', bucket)
+        return objects
+
+    def _list_buckets(self):
+        inner = ''.join(['<Bucket><Name>%s</Name><CreationDate>%s'
+                         '</CreationDate></Bucket>' % (escape(name),
+                                                       LAST_MODIFIED)
+                         for name in sorted(self.server.store.buckets)])
+        self._xml('ListAllMyBucketsResult',
+                  '<Owner><ID>fake</ID><DisplayName>fake</DisplayName>'
+                  '</Owner><Buckets>%s</Buckets>' % inner)
+
+    def _bucket(self, method, bucket, params, body):
+        store = self.server.store
+        if method == 'PUT':
+            if 'acl' not in params:
+                with store._lock:
+                    store.buckets.setdefault(bucket, {})
+            return self._send(200)
+
+        objects = self._objects(bucket)
+        if method == 'HEAD':
+            return self._send(200, head=True)
+        elif method == 'DELETE':
+            with store._lock:
+                del store.buckets[bucket]
+            return self._send(204)
+        elif method == 'POST' and 'delete' in params:
+            return self._delete_objects(bucket, objects, body)
+        elif 'location' in params:
+            return self._xml('LocationConstraint', '')
+        elif 'acl' in params:
+            return self._xml('AccessControlPolicy',
+                             '<Owner><ID>fake</ID></Owner>'
+                             '<AccessControlList></AccessControlList>')
+
+        prefix = params.get('prefix', '')
+        marker = params.get('marker', '')
+        maxkeys = int(params.get('max-keys', 1000))
+        names = store.names(bucket)
+        if marker >= prefix:
+            start = bisect.bisect_right(names, marker)
+        else:
+            start = bisect.bisect_left(names, prefix)
+        page = []
+        for name in names[start:]:
+            if not name.startswith(prefix) or len(page) > maxkeys:
+                break
+            page.append(name)
+        truncated = len(page) > maxkeys
+        contents = []
+        for name in page[:maxkeys]:
+            size, etag, data = objects[name]
+            contents.append('<Contents><Key>%s</Key><LastModified>%s'
+                            '</LastModified><ETag>&quot;%s&quot;</ETag>'
+                            '<Size>%i</Size><StorageClass>STANDARD'
+                            '</StorageClass></Contents>' % (
+                            escape(name), LAST_MODIFIED, etag, size))
+        self._xml('ListBucketResult',
+                  '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>'
+                  '<MaxKeys>%i</MaxKeys><IsTruncated>%s</IsTruncated>%s' % (
+                  escape(bucket), escape(prefix), escape(marker), maxkeys,
+                  truncated and 'true' or 'false', ''.join(contents)))
+
+    def _delete_objects(self, bucket, objects, body):
+        root = ElementTree.fromstring(body)
+        quiet = False
+        names = []
+        for element in root.iter():
+            tag = element.tag.split('}')[-1]
+            if tag == 'Quiet':
+                quiet = element.text == 'true'
+            elif tag == 'Key':
+                names.append(element.text)
+
+        deleted = []
+        for name in names:
+            self.server.store.delete(bucket, name)
+            deleted.append('<Deleted><Key>%s</Key></Deleted>' % escape(name))
+        self._xml('DeleteResult', not quiet and ''.join(deleted) or '')
+
+    def _object(self, method, bucket, name, params, body):
+        store = self.server.store
+        objects = self._objects(bucket)
+
+        if method == 'PUT' and 'uploadId' in params:
+            return self._put_part(params, body)
+        elif method == 'PUT':
+            md5 = self.headers.get('Content-MD5')
+            if md5 and base64.b64decode(md5) != hashlib.md5(body).digest():
+                raise S3Error(400, 'BadDigest', name)
+            etag = store.put(bucket, name, body)
+            return self._send(200, headers={'ETag': '"%s"' % etag})
+        elif method == 'POST' and 'uploads' in params:
+            upload_id = store.new_upload(bucket, name)
+            return self._xml('InitiateMultipartUploadResult',
+                             '<Bucket>%s</Bucket><Key>%s</Key>'
+                             '<UploadId>%s</UploadId>' % (
+                             escape(bucket), escape(name), upload_id))
+        elif method == 'POST' and 'uploadId' in params:
+            return self._complete_upload(params['uploadId'])
+        elif method == 'GET' and 'uploadId' in params:
+            return self._list_parts(params['uploadId'])
+        elif method == 'DELETE' and 'uploadId' in params:
+            with store._lock:
+                store.uploads.pop(params['uploadId'], None)
+            return self._send(204)
+        elif method == 'DELETE':
+            store.delete(bucket, name)
+            return self._send(204)
+
+        if name not in objects:
+            raise S3Error(404, 'NoSuchKey', name)
+        size, etag, data = objects[name]
+        if data is None and method == 'GET':
+            raise S3Error(404, 'NoSuchKey', '%s was not stored' % name)
+        headers = {'ETag': '"%s"' % etag,
+                   'Last-Modified': 'Tue, 01 Jan 2013 00:00:00 GMT',
+                   'Content-Type': 'application/octet-stream'}
+        if method == 'HEAD':
+            self.send_response(200)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+        else:
+            self._send(200, data, headers)
+
+    def _put_part(self, params, body):
+        store = self.server.store
+        upload = store.uploads.get(params['uploadId'])
+        if upload is None:
+            raise S3Error(404, 'NoSuchUpload', params['uploadId'])
+        md5 = self.headers.get('Content-MD5')
+        digest = hashlib.md5(body)
+        if md5 and base64.b64decode(md5) != digest.digest():
+            raise S3Error(400, 'BadDigest', params['partNumber'])
+        with store._lock:
+            upload[2][int(params['partNumber'])] = (
+                digest.digest(), store.store and body or None, len(body))
+        self._send(200, headers={'ETag': '"%s"' % digest.hexdigest()})
+
+    def _list_parts(self, upload_id):
+        upload = self.server.store.uploads.get(upload_id)
+        if upload is None:
+            raise S3Error(404, 'NoSuchUpload', upload_id)
+        bucket, name, parts = upload
+        self._xml('ListPartsResult',
+                  '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                  '<IsTruncated>false</IsTruncated>%s' % (
+                  escape(bucket), escape(name), upload_id,
+                  ''.join(['<Part><PartNumber>%i</PartNumber><LastModified>'
+                           '%s</LastModified><ETag>&quot;%s&quot;</ETag>'
+                           '<Size>%i</Size></Part>' % (
+                           n, LAST_MODIFIED, parts[n][0].encode('hex'),
+                           parts[n][2]) for n in sorted(parts)])))
+
+    def _complete_upload(self, upload_id):
+        store = self.server.store
+        with store._lock:
+            upload = store.uploads.pop(upload_id, None)
+        if upload is None:
+            raise S3Error(404, 'NoSuchUpload', upload_id)
+        bucket, name, parts = upload
+        numbers = sorted(parts)
+        etag = '%s-%i' % (hashlib.md5(''.join([parts[n][0] for n in numbers])
+                                      ).hexdigest(), len(numbers))
+        size = sum([parts[n][2] for n in numbers])
+        data = None
+        if store.store:
+            data = ''.join([parts[n][1] for n in numbers])
+        store.put(bucket, name, size=size, etag=etag)
+        if data is not None:
+            store.buckets[bucket][name] = (size, etag, data)
+        self._xml('CompleteMultipartUploadResult',
+                  '<Bucket>%s</Bucket><Key>%s</Key><ETag>&quot;%s&quot;'
+                  '</ETag>' % (escape(bucket), escape(name), etag))
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "A FakeS3Store served over HTTP, one thread per connection"
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, failure_rate=0,
+                 store=True):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeS3Handler)
+        self.store = FakeS3Store(store)
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    @property
+    def port(self):     # property
+        return self.server_address[1]
+
+    def start(self):
+        "Serves from a background thread; returns self"
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='fakes3')
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options]",
+        description="Runs a local stand-in for S3 until interrupted.")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8053,
+                      help="Port to listen on (default=8053)")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+                      default=0, help="Seconds to hold up each request")
+    parser.add_option("-f", "--failure-rate", dest="failure_rate",
+                      type="float", default=0,
+                      help="Fraction of object requests to fail")
+    parser.add_option("-d", "--discard", dest="store", action="store_false",
+                      default=True, help="Keep sizes and ETags, not data")
+    (options, args) = parser.parse_args()
+
+    server = FakeS3Server(('127.0.0.1', options.port), options.latency,
+                          options.failure_rate, options.store)
+    print("Fake S3 listening on 127.0.0.1:%i" % server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
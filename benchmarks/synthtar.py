@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#
+# Synthetic tar streams for the benchmarks
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Writes a tar stream of made-up files to stdout, standing in for
+BackupPC_tarCreate.  Its arguments are ignored; the stream is described by
+the environment instead:
+
+    SYNTHTAR_SIZE            total bytes of file contents (default 256MB)
+    SYNTHTAR_FILESIZE        bytes per file (default 1MB)
+    SYNTHTAR_COMPRESSIBILITY fraction of each block that is a repeated
+                             pattern rather than random (default 0.5)
+    SYNTHTAR_SEED            seed, so a run's files can be made again
+"""
+
+import os
+import random
+import sys
+import tarfile
+import time
+
+BLOCKSIZE = 65536
+
+# Random blocks are slices of this much noise, which is more than any of the
+# compressors look back over.
+POOLSIZE = 16 * 1024 * 1024
+_pool = None
+
+
+def noise_pool():
+    "Returns POOLSIZE bytes of noise, the same every time"
+    global _pool
+    if _pool is None:
+        bits = random.Random(0).getrandbits(POOLSIZE * 8)
+        _pool = ('%0*x' % (POOLSIZE * 2, bits)).decode('hex')
+    return _pool
+
+
+class SyntheticFile(object):
+    """A file-like object of size bytes, where compressibility of every
+       block is a repeated pattern and the rest is noise."""
+
+    def __init__(self, size, compressibility, seed):
+        self.remaining = size
+        self.random = random.Random(seed)
+        self.fixed = int(BLOCKSIZE * compressibility)
+        pattern = '%s\n' % seed
+        self.pattern = (pattern * (BLOCKSIZE // len(pattern) + 1))[:self.fixed]
+        self.buffer = ''
+
+    def block(self):
+        start = self.random.randrange(POOLSIZE - BLOCKSIZE)
+        return self.pattern + noise_pool()[start:start + BLOCKSIZE - self.fixed]
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.remaining
+        size = min(size, self.remaining)
+        while len(self.buffer) < size:
+            self.buffer += self.block()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.remaining -= size
+        return data
+
+
+def write_tar(fp, size, filesize=1048576, compressibility=0.5, seed=0):
+    "Writes a tar stream of files adding up to size bytes to fp"
+    tar = tarfile.open(fileobj=fp, mode='w|', format=tarfile.GNU_FORMAT)
+    now = int(time.time())
+    written = 0
+    number = 0
+    while written < size:
+        thissize = min(filesize, size - written)
+        info = tarfile.TarInfo('./synthetic/%03i/file%06i' % (number // 1000,
+                                                             number))
+        info.size = thissize
+        info.mtime = now
+        info.mode = 0644
+        tar.addfile(info, SyntheticFile(thissize, compressibility,
+                                        '%s-%i' % (seed, number)))
+        written += thissize
+        number += 1
+    tar.close()
+
+
+def main():
+    env = os.environ
+    write_tar(sys.stdout,
+              int(env.get('SYNTHTAR_SIZE', 256 * 1024 * 1024)),
+              int(env.get('SYNTHTAR_FILESIZE', 1048576)),
+              float(env.get('SYNTHTAR_COMPRESSIBILITY', 0.5)),
+              env.get('SYNTHTAR_SEED', '0'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#
+# Tests backup-manager.py's deletes against a local stand-in for S3
+#
+# Copyright (c) 2009-2013 Ryan S. Tucker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Deletes deduplicated backups that share chunks from fakes3.py, checking
+that a chunk only outlives the backups referring to it once none of them
+can look finalized.
+
+    python -m unittest discover tests
+"""
+
+import imp
+import json
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(TESTDIR)
+sys.path.insert(0, os.path.join(REPO, 'benchmarks'))
+sys.path.insert(1, REPO)
+
+import archivelib
+import fakes3
+
+ACCESSKEY = 'TESTACCESSKEY'
+BUCKET = ACCESSKEY.lower() + '-bkup-h'
+SHARED = archivelib.CHUNK_PREFIX + 'shared.gpg'
+
+
+def load_manager(port):
+    config = types.ModuleType('secrets')
+    config.__dict__.update({
+        'accesskey': ACCESSKEY,
+        'sharedkey': 'testsharedkey',
+        's3_host': '127.0.0.1',
+        's3_port': port,
+        's3_secure': False,
+    })
+    sys.modules['secrets'] = config
+    return imp.load_source('backup_manager',
+                           os.path.join(REPO, 'backup-manager.py'))
+
+
+def put_backup(store, backupnum, chunks):
+    "Stores a finalized deduplicated backup of host h made of chunks"
+    manifest = {
+        'version': 1,
+        'hostname': 'h',
+        'backupnum': backupnum,
+        'dedup': True,
+        'size': len(chunks),
+        'chunks': [{'hash': name, 'size': 1, 'key': name} for name in chunks],
+    }
+    for name in chunks:
+        store.put(BUCKET, name, 'x')
+    store.put(BUCKET, 'h.%i.tar.MANIFEST' % backupnum, json.dumps(manifest))
+    store.put(BUCKET, 'h.%i.tar.COMPLETE' % backupnum, 'done')
+
+
+class DeleteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakes3.FakeS3Server().start()
+        self.store = self.server.store
+        self.manager = load_manager(self.server.port)
+        self.statedir = tempfile.mkdtemp()
+        put_backup(self.store, 1, [archivelib.CHUNK_PREFIX + 'one.gpg',
+                                   SHARED])
+        put_backup(self.store, 2, [SHARED])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.statedir)
+
+    def bmgr(self):
+        catalog = archivelib.Catalog(self.statedir, 86400)
+        return self.manager.BackupManager(ACCESSKEY, 'testsharedkey',
+                                          catalog=catalog)
+
+    def sweep(self, bmgr, failing=()):
+        """Deletes backups 1 and 2 together, with every delete of a name in
+           failing going wrong; returns {backupnum: errors}"""
+        real = bmgr._delete_names
+
+        def delete_names(bucketname, names, retries=5):
+            bad = [name for name in names if name in failing]
+            deleted, errors = real(bucketname,
+                                   [n for n in names if n not in bad], 0)
+            for name in bad:
+                errors[name] = 'InternalError: injected'
+            return deleted, errors
+        bmgr._delete_names = delete_names
+
+        backups = bmgr.all_backups['h']
+        deleting = [backups[1], backups[2]]
+        return dict([(backup['backupnum'], errors) for backup, deleted, errors
+                     in bmgr.delete_backups(deleting, retries=0)])
+
+    def test_shared_chunk_goes_with_the_sweep(self):
+        results = self.sweep(self.bmgr())
+        self.assertEqual(results, {1: {}, 2: {}})
+        self.assertEqual(self.store.names(BUCKET), [])
+
+        # and the catalog knows it
+        bmgr = self.bmgr()
+        self.assertEqual(bmgr.all_backups, {})
+
+    def test_shared_chunk_outlives_an_undeleted_complete(self):
+        results = self.sweep(self.bmgr(), failing=['h.2.tar.COMPLETE'])
+        self.assertEqual(results[1], {})
+        self.assertEqual(results[2].keys(), ['h.2.tar.COMPLETE'])
+
+        # backup 2 still looks finalized, so it must still be whole
+        self.assertEqual(self.store.names(BUCKET),
+                         [SHARED, 'h.2.tar.COMPLETE', 'h.2.tar.MANIFEST'])
+        bmgr = self.bmgr()
+        self.assertEqual(bmgr.all_backups['h'].keys(), [2])
+        self.assertTrue(bmgr.all_backups['h'][2]['finalized'])
+
+    def test_no_chunk_goes_before_every_complete(self):
+        # a chunk delete failing in backup 1 mustn't leave 2 finalized
+        results = self.sweep(self.bmgr(), failing=[SHARED])
+        self.assertEqual(results[1].keys(), [SHARED])
+        self.assertEqual(results[2], {})
+        self.assertTrue('h.1.tar.COMPLETE' not in self.store.names(BUCKET))
+        self.assertTrue('h.2.tar.COMPLETE' not in self.store.names(BUCKET))
+
+
+if __name__ == '__main__':
+    unittest.main()